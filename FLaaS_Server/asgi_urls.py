@@ -0,0 +1,12 @@
+"""FLaaS_Server URL Configuration for ASGI requests
+
+Same as FLaaS_Server.urls, except for the device-facing endpoints that are served by async views
+(see api/async_views.py). Selected per request by FLaaS_Server.middleware.asgi_urlconf_middleware.
+"""
+from django.urls import include, path
+
+from FLaaS_Server.urls import urlpatterns as wsgi_urlpatterns
+
+urlpatterns = [
+    path('api/', include('api.async_urls')),
+] + wsgi_urlpatterns
@@ -0,0 +1,26 @@
+import asyncio
+
+from django.core.handlers.asgi import ASGIRequest
+from django.utils.decorators import sync_and_async_middleware
+
+
+ASGI_URLCONF = 'FLaaS_Server.asgi_urls'
+
+
+@sync_and_async_middleware
+def asgi_urlconf_middleware(get_response):
+
+    # route requests served through ASGI to the async views
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            if isinstance(request, ASGIRequest):
+                request.urlconf = ASGI_URLCONF
+            return await get_response(request)
+
+    else:
+        def middleware(request):
+            if isinstance(request, ASGIRequest):
+                request.urlconf = ASGI_URLCONF
+            return get_response(request)
+
+    return middleware
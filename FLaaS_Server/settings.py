@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import tempfile
 import django_heroku
 
 from datetime import timedelta
@@ -64,6 +65,7 @@ SIMPLE_JWT = {
 }
 
 MIDDLEWARE = [
+    'FLaaS_Server.middleware.asgi_urlconf_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -160,10 +162,84 @@ AWS_S3_BUCKET_NAME_STATIC = os.environ.get('AWS_S3_BUCKET_NAME_STATIC')
 AWS_REGION = os.environ.get('AWS_REGION')
 AWS_S3_FILE_OVERWRITE = True
 AWS_S3_ADDRESSING_STYLE = "path"
+AWS_S3_MAX_AGE_SECONDS = int(os.environ.get('AWS_S3_MAX_AGE_SECONDS', 3600))  # expiry of signed urls
+
+# Cache shared across workers (create its table with: python manage.py createcachetable). It holds a few
+# entries per round and per samples index of the devices, so it is sized for the fleet (entries are culled
+# beyond CACHE_MAX_ENTRIES)
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 100000))
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'api_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': CACHE_MAX_ENTRIES,
+        },
+    }
+}
+
+# Signed urls of models and samples are cached for less than they are valid
+URL_CACHE_TIMEOUT = min(int(os.environ.get('URL_CACHE_TIMEOUT', 1800)), AWS_S3_MAX_AGE_SECONDS // 2)  # seconds
 
 # Increase memory sizes
 DATA_UPLOAD_MAX_MEMORY_SIZE = 30000000
 FILE_UPLOAD_MAX_MEMORY_SIZE = 30000000
 
+# Model aggregation
+AGGREGATION_CHUNK_SIZE = int(os.environ.get('AGGREGATION_CHUNK_SIZE', 1048576))  # bytes read per block from each device model
+AGGREGATION_DTYPE = os.environ.get('AGGREGATION_DTYPE', 'float64')  # accumulator precision ('float32' or 'float64')
+AGGREGATION_FETCH_WORKERS = int(os.environ.get('AGGREGATION_FETCH_WORKERS', 8))  # device models downloaded in parallel
+
+# Model downloads: 'redirect' (to a signed storage url), 'direct' (served by the server, with HTTP Range support)
+# or 'cached' (served by the server from a local disk cache)
+MODEL_SERVING = os.environ.get('MODEL_SERVING', 'redirect')
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'flaas-models'))
+MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', 1073741824))  # bytes
+
+# Direct uploads (presigned S3 urls, or signed local upload urls)
+UPLOAD_URL_EXPIRY = int(os.environ.get('UPLOAD_URL_EXPIRY', 900))  # seconds
+
+# Device pings are inserted in bulk, every STATUS_BUFFER_SIZE rows or STATUS_BUFFER_INTERVAL ms (1 disables buffering)
+STATUS_BUFFER_SIZE = int(os.environ.get('STATUS_BUFFER_SIZE', 1))
+STATUS_BUFFER_INTERVAL = int(os.environ.get('STATUS_BUFFER_INTERVAL', 1000))  # milliseconds
+
+# Device pings older than STATUS_RETENTION_DAYS (unless set per project) are rolled up per device and hour, archived
+# into the storage (gzipped JSON lines, unless STATUS_ARCHIVE is 'False') and deleted, in batches of
+# STATUS_RETENTION_BATCH_SIZE rows (at most STATUS_RETENTION_TICK_BATCHES per tick)
+STATUS_RETENTION_DAYS = int(os.environ.get('STATUS_RETENTION_DAYS', 30))
+STATUS_ARCHIVE = os.environ.get('STATUS_ARCHIVE', 'True') != 'False'
+STATUS_RETENTION_BATCH_SIZE = int(os.environ.get('STATUS_RETENTION_BATCH_SIZE', 5000))
+STATUS_RETENTION_TICK_BATCHES = int(os.environ.get('STATUS_RETENTION_TICK_BATCHES', 10))
+
+# Scheduler daemon (the scheduler command, instead of a periodic tick): events are polled every SCHEDULER_POLL_INTERVAL,
+# device availability is checked every SCHEDULER_AVAILABILITY_INTERVAL and the rest of the tick runs every
+# SCHEDULER_MAINTENANCE_INTERVAL
+SCHEDULER_POLL_INTERVAL = float(os.environ.get('SCHEDULER_POLL_INTERVAL', 1))  # seconds
+SCHEDULER_AVAILABILITY_INTERVAL = int(os.environ.get('SCHEDULER_AVAILABILITY_INTERVAL', 60))  # seconds
+SCHEDULER_MAINTENANCE_INTERVAL = int(os.environ.get('SCHEDULER_MAINTENANCE_INTERVAL', 600))  # seconds
+
+# Projects checked concurrently by the scheduler (tick and scheduler command). A project is claimed while being
+# checked, for SCHEDULER_LEASE seconds renewed every third of it (checks that stop renewing it are considered dead)
+SCHEDULER_WORKERS = int(os.environ.get('SCHEDULER_WORKERS', 4))
+SCHEDULER_LEASE = int(os.environ.get('SCHEDULER_LEASE', 60))  # seconds
+
+# Push notifications (queued in an outbox and sent in the background): PUSH_BATCH_SIZE users per message, up to
+# PUSH_WORKERS messages at once, retried PUSH_RETRIES times (after PUSH_RETRY_BACKOFF seconds, doubled per attempt)
+PUSHWOOSH_API_URL = os.environ.get('PUSHWOOSH_API_URL', 'https://cp.pushwoosh.com/json/1.3/')
+PUSH_TIMEOUT = float(os.environ.get('PUSH_TIMEOUT', 10))  # seconds
+PUSH_BATCH_SIZE = max(1, int(os.environ.get('PUSH_BATCH_SIZE', 1000)))
+PUSH_WORKERS = int(os.environ.get('PUSH_WORKERS', 4))
+PUSH_RETRIES = int(os.environ.get('PUSH_RETRIES', 5))
+PUSH_RETRY_BACKOFF = float(os.environ.get('PUSH_RETRY_BACKOFF', 5))  # seconds
+
+# Train requests are pushed again (at most PUSH_MAX_REPUSHES times) to devices that don't acknowledge them
+# (join the round) within PUSH_ACK_TIMEOUT
+PUSH_ACK_TIMEOUT = int(os.environ.get('PUSH_ACK_TIMEOUT', 300))  # seconds
+PUSH_MAX_REPUSHES = int(os.environ.get('PUSH_MAX_REPUSHES', 2))
+
+# Additional model architectures (comma-separated 'NAME:Label', with models/NAME.bin and optionally models/NAME.json)
+EXTRA_MODELS = tuple(
+    tuple((model.split(':', 1) + [model])[:2]) for model in os.environ.get('EXTRA_MODELS', '').split(',') if model)
+
 # Activate Django-Heroku.
 django_heroku.settings(locals())
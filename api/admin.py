@@ -1,7 +1,11 @@
 from django.contrib import admin
-from api.models import Profile, Project, Device
+from api.models import Profile, Project, Device, DeviceLatestStatus, DeviceStatusRollup, PushMessage, TrainRequestDelivery
 
 # Register your models here.
 admin.site.register(Profile)
 admin.site.register(Project)
 admin.site.register(Device)
+admin.site.register(DeviceLatestStatus)
+admin.site.register(DeviceStatusRollup)
+admin.site.register(PushMessage)
+admin.site.register(TrainRequestDelivery)
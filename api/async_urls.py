@@ -0,0 +1,17 @@
+from django.urls import path
+
+from api import async_views
+
+# device-facing endpoints served by async views under ASGI (the rest falls through to api.urls)
+urlpatterns = [
+
+    # Samples
+    path('get-samples/<str:dataset_type>/<str:app>/', async_views.get_samples, name='get-samples'),
+
+    # Project
+    path('project/<int:project_id>/get-model/<str:round>/', async_views.get_model, name='get-model'),
+    path('project/<int:project_id>/join-round/<str:round>/', async_views.join_round, name='join-round'),
+
+    # Reporting
+    path('report-availability', async_views.report_availability, name='report-availability'),
+]
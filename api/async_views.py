@@ -0,0 +1,91 @@
+import json
+import functools
+
+from asgiref.sync import sync_to_async
+
+from django.db import close_old_connections
+from django.http import HttpResponse, JsonResponse
+
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotAuthenticated
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from api import views
+from api.models import JoinedRounds
+
+
+# Async versions of the device-facing endpoints (served through ASGI, see FLaaS_Server/asgi_urls.py), so a
+# worker can hold many concurrent device connections while their database and storage work runs in a thread
+# pool. Each endpoint reuses the logic of its sync view.
+
+
+def _threaded(func):
+
+    # run in the thread pool (not in the single thread of sync views), dropping broken or expired connections
+    def run(*args, **kwargs):
+        close_old_connections()
+        return func(*args, **kwargs)
+
+    return sync_to_async(run, thread_sensitive=False)
+
+
+def _authenticate(request):
+
+    # device of the JWT user
+    result = JWTAuthentication().authenticate(request)
+    if result is None:
+        raise NotAuthenticated()
+
+    user, _ = result
+    return user.profile.device
+
+
+def device_view(view):
+
+    # authenticate the device, reporting API errors as the sync views do
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            device = await _threaded(_authenticate)(request)
+            return await view(request, device, *args, **kwargs)
+
+        except APIException as ex:
+            return JsonResponse({'detail': ex.detail}, status=ex.status_code)
+
+    wrapper.csrf_exempt = True
+    return wrapper
+
+
+@device_view
+async def get_samples(request, device, dataset_type, app):
+    return await _threaded(views.samples_response)(device, dataset_type, app)
+
+
+@device_view
+async def get_model(request, device, project_id, round):
+    return await _threaded(views.model_response)(request, project_id, round)
+
+
+@device_view
+async def join_round(request, device, project_id, round):
+
+    # get status param (if available, if not get JOIN_ROUND)
+    join_status = request.GET.get("status", JoinedRounds.Status.JOIN_ROUND)
+
+    return JsonResponse(await _threaded(views.join_round)(device, project_id, round, join_status))
+
+
+@device_view
+async def report_availability(request, device):
+
+    if request.method != 'POST':
+        return HttpResponse(status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
+
+    return HttpResponse(status=await _threaded(views.report_availability)(device, data))
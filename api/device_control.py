@@ -1,7 +1,10 @@
+from datetime import timedelta
+
+from django.conf import settings
 from django.utils import timezone
 
-from api.libs import pushwoosh_api as push
-from api.models import DeviceTrainRequest, Project, Round
+from api import push_outbox as push
+from api.models import DeviceTrainRequest, Project, Round, TrainRequestDelivery
 
 
 # return all usernames for each device.user belonging to the given project
@@ -11,7 +14,39 @@ def _get_user_ids(devices):
     return user_ids
 
 
-def send_train_request(project, devices, verbose=False):
+def _train_data(project, round, request):
+
+    # compute training request validity (from the time of the request)
+    valid_date = int((request.create_date.timestamp() + project.max_training_time * 60) * 1000)
+
+    # build data payload
+    return {
+        'type': 'train',
+        'validDate': valid_date,
+        'request': request.id,
+        'project': project.id,
+        'round': round.round_number,
+        'trainingMode': round.training_mode,
+    }
+
+
+def _push_train_request(project, round, request, devices, ttl, verbose=False):
+
+    # get user_ids
+    user_ids = _get_user_ids(devices)
+    data = _train_data(project, round, request)
+
+    if verbose:
+        print("\tusers:" + str(user_ids))
+        print("\tdata: " + str(data))
+
+    # send push notification, returns the message of each device
+    messages = push.send_data(user_ids, data, ttl, verbose, train_request=request)
+    message_ids = dict((user_id, message.id) for message in messages for user_id in message.users)
+    return [message_ids[user_id] for user_id in user_ids]
+
+
+def send_train_request(project, devices, verbose=False, round=None):
 
     # check if project is started
     if project.status != Project.STATUS_CHOICES[1][0]:
@@ -22,10 +57,11 @@ def send_train_request(project, devices, verbose=False):
         print("No devices available.")
         return
 
-    # get round model of current round
-    round = Round.objects.get(
-        project=project,
-        round_number=project.current_round)
+    # get round model of current round (if not given)
+    if round is None:
+        round = Round.objects.get(
+            project=project,
+            round_number=project.current_round)
 
     # create DeviceTrainRequest object
     request = DeviceTrainRequest.objects.create(
@@ -33,30 +69,46 @@ def send_train_request(project, devices, verbose=False):
 
     # now set the devices
     request.devices.set(devices)
-    request.save()
 
-    # compute training request validity
-    valid_date = int((timezone.now().timestamp() + project.max_training_time * 60) * 1000)
+    # send push notification
+    ttl = project.max_training_time
+    message_ids = _push_train_request(project, round, request, devices, ttl, verbose)
+
+    # track its delivery to each device
+    TrainRequestDelivery.objects.bulk_create([
+        TrainRequestDelivery(train_request=request, device=device, message_id=message_id)
+        for device, message_id in zip(devices, message_ids)])
 
-    # build data payload
-    data = {
-        'type': 'train',
-        'validDate': valid_date,
-        'request': request.id,
-        'project': project.id,
-        'round': round.round_number,
-        'trainingMode': round.training_mode,
-    }
+    return request.id
 
-    # get user_ids
-    user_ids = _get_user_ids(devices)
 
-    if verbose:
-        print("\tusers:" + str(user_ids))
-        print("\tdata: " + str(data))
+def repush_train_request(round, verbose=False):
 
-    # send push notification
-    ttl = project.max_training_time
-    push.send_data(user_ids, data, ttl, verbose)
+    # push the train request of the round again to the devices that haven't acknowledged it within
+    # PUSH_ACK_TIMEOUT (at most PUSH_MAX_REPUSHES times), returns the number of devices
+    project = round.project
+    now = timezone.now()
 
-    return request.id
+    deliveries = list(TrainRequestDelivery.objects.filter(
+        train_request__round=round,
+        ack_date__isnull=True,
+        last_push_date__lte=now - timedelta(seconds=settings.PUSH_ACK_TIMEOUT),
+        pushes__lte=settings.PUSH_MAX_REPUSHES).select_related('train_request', 'device__profile__user'))
+
+    # not if the request expires anyway before the device could train
+    ttl = int((round.start_training_date + timedelta(minutes=project.max_training_time) - now).total_seconds() / 60)
+    if not deliveries or ttl <= 0:
+        return 0
+
+    verbose and print("Pushing the train request again to %d devices." % len(deliveries))
+
+    request = deliveries[0].train_request
+    message_ids = _push_train_request(project, round, request, [delivery.device for delivery in deliveries], ttl, verbose)
+
+    for delivery, message_id in zip(deliveries, message_ids):
+        delivery.message_id = message_id
+        delivery.pushes += 1
+        delivery.last_push_date = now
+    TrainRequestDelivery.objects.bulk_update(deliveries, ['message', 'pushes', 'last_push_date'])
+
+    return len(deliveries)
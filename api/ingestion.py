@@ -0,0 +1,78 @@
+import atexit
+import threading
+
+from django.db import close_old_connections
+
+
+class BulkBuffer:
+
+    # Buffers model instances of a hot write path and inserts them with bulk_create, once 'size' rows are
+    # buffered or every 'interval' milliseconds (whichever comes first), from a background thread. Rows are
+    # buffered per process and flushed at exit. auto_now_add fields are set when the rows are flushed (at
+    # most 'interval' later). A size of 1 (or less) disables buffering.
+
+    def __init__(self, model, size, interval):
+        self.model = model
+        self.size = size
+        self.interval = interval / 1000
+
+        self._rows = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wakeup = threading.Event()
+
+    def add(self, obj):
+
+        if self.size <= 1:
+            obj.save()
+            return
+
+        with self._lock:
+            self._rows.append(obj)
+            full = len(self._rows) >= self.size
+
+            # periodic flushes (started with the first row)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="bulkbuffer:%s" % self.model.__name__, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+        # flushed by the background thread (not by the request adding the row)
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+
+        with self._lock:
+            rows, self._rows = self._rows, []
+
+        if not rows:
+            return 0
+
+        try:
+            self.model.objects.bulk_create(rows, batch_size=self.size)
+
+        # a single invalid row fails the whole insert, save the rows one by one instead (only the invalid
+        # ones are lost)
+        except Exception as ex:
+            print("Unable to insert %d buffered %s rows at once, inserting them one by one: %s" % (len(rows), self.model.__name__, ex))
+            for row in rows:
+                try:
+                    row.pk = None
+                    row.save(force_insert=True)
+                except Exception as ex:
+                    print("Unable to insert buffered %s row: %s" % (self.model.__name__, ex))
+
+        return len(rows)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                print("Unable to flush buffered %s rows: %s" % (self.model.__name__, ex))
+
+            # don't keep a broken connection around
+            close_old_connections()
@@ -1,10 +1,12 @@
 MODEL_WEIGHTS_FILENAME = "model_weights.bin"
+PARTIAL_WEIGHTS_FILENAME = "partial_weights.bin"
+PREVIOUS_SUFFIX = ".previous"
 SAMPLES_FILENAME = "samples.bin"
 PERFORMANCE_FILENAME = "performance.json"
+OPTIMIZER_STATE_FILENAME = "server_optimizer.npz"
 RESULTS_FIGURE_FILENAME = 'Figure_Acc_Per_Round.pdf'
 
 MODELS_PATH = 'models'
 SAMPLES_PATH = 'samples'
 PROJECTS_PATH = 'projects'
-
-MODEL_SIZE = 627210  # TODO: get value from model
+STATUS_ARCHIVE_PATH = 'archive/device_status_responses'
@@ -0,0 +1,71 @@
+import json
+import time
+import uuid
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Local stand-in for the Pushwoosh API, for tests and load runs (set PUSHWOOSH_API_URL to its url). It accepts
+# createMessage requests and records them, optionally answering slowly or failing the first requests.
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+
+        time.sleep(server.delay)
+
+        with server.lock:
+            fail = server.failures > 0
+            if fail:
+                server.failures -= 1
+            else:
+                server.requests.append((self.path.rsplit('/', 1)[-1], json.loads(body)['request']))
+
+        if fail:
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        response = json.dumps({
+            'status_code': 200,
+            'status_message': 'OK',
+            'response': {'Messages': [uuid.uuid4().hex]},
+        }).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        self.server.verbose and super().log_message(format, *args)
+
+
+class FakePushwoosh(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, failures=0, verbose=False):
+        super().__init__((host, port), _Handler)
+        self.delay = delay
+        self.failures = failures
+        self.verbose = verbose
+
+        # (method, request) of each accepted request
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d/json/1.3/' % self.server_address[:2]
+
+    def start(self):
+
+        # serve in a background thread (stopped with shutdown())
+        threading.Thread(target=self.serve_forever, name='fake-pushwoosh', daemon=True).start()
+        return self
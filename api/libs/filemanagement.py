@@ -1,15 +1,162 @@
 import os
+import time
+import hashlib
+import shutil
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 
 
+def localpath(path):
+
+    # path of a file in the local filesystem (None if the storage is not local)
+    try:
+        return default_storage.path(path)
+    except NotImplementedError:
+        return None
+
+
 def filecopy(from_path, to_path):
+
+    # local filesystem: hard-link (or kernel-side copy when linking is not possible)
+    local_from_path = localpath(from_path)
+    if local_from_path is not None:
+        local_to_path = localpath(to_path)
+        os.makedirs(os.path.dirname(local_to_path), exist_ok=True)
+        if os.path.exists(local_to_path):
+            os.remove(local_to_path)
+        try:
+            os.link(local_from_path, local_to_path)
+        except OSError:
+            shutil.copyfile(local_from_path, local_to_path)
+        return
+
+    # storage-native copy (e.g. S3 CopyObject)
+    if hasattr(default_storage, 'copy'):
+        default_storage.copy(from_path, to_path)
+        return
+
+    # otherwise stream it through (saved in chunks, never read at once)
     with default_storage.open(from_path) as original_file:
-        default_storage.save(to_path, ContentFile(original_file.read()))
+        filereplace(to_path, original_file)
+
+
+def filereplace(path, content):
+
+    # storages that never overwrite (e.g. local filesystem) would save under a new name
+    if default_storage.get_available_name(path) != path:
+        default_storage.delete(path)
+
+    return default_storage.save(path, content)
+
+
+def filechecksum(data):
+
+    # sha1 of a file, read in chunks
+    checksum = hashlib.sha1()
+    for chunk in data.chunks():
+        checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def fileversion(path):
+
+    # identifies the content of a file, from its metadata where the storage has it (S3: the ETag of the
+    # object, so it is not downloaded), otherwise its sha1 checksum. Raises OSError if it doesn't exist
+    if hasattr(default_storage, 's3_connection'):
+        return default_storage.meta(path)['ETag'].strip('"')
+
+    with default_storage.open(path) as data:
+        return filechecksum(data)
+
+
+def _timed_open(path):
+    start = time.perf_counter()
+    try:
+        file = default_storage.open(path)
+    except (OSError, IOError) as ex:
+        print("Something went wrong while fetching file at '%s'" % path)
+        print(ex)
+        file = None
+    return path, file, time.perf_counter() - start
+
+
+def fetchfiles(paths, workers):
+
+    # open (download) files concurrently, yielding (path, file, elapsed_secs) in completion order.
+    # At most 'workers' files are in flight at any time. Files are None on failure and must be
+    # closed by the caller.
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+
+        # fill the window
+        pending = set()
+        for path in paths:
+            pending.add(executor.submit(_timed_open, path))
+            if len(pending) >= workers:
+                break
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+
+                # refill the window before handing over the file
+                for path in paths:
+                    pending.add(executor.submit(_timed_open, path))
+                    break
 
+                yield future.result()
 
-def delfolder(path):
+
+# S3 DeleteObjects accepts up to 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+
+def _report_progress(path, deleted, verbose):
+    verbose and print("Deleted %d files under '%s'." % (deleted, path))
+
+
+def _delfolder_local(path, local_path, verbose):
+
+    deleted = 0
+    for folder, _, files in os.walk(local_path, topdown=False):
+        for file in files:
+            os.remove(os.path.join(folder, file))
+        os.rmdir(folder)
+
+        deleted += len(files)
+        if files:
+            _report_progress(path, deleted, verbose)
+
+    return deleted
+
+
+def _delfolder_s3(path, verbose):
+
+    bucket = default_storage.settings.AWS_S3_BUCKET_NAME
+    prefix = default_storage._get_key_name(path) + '/'
+
+    # list by prefix (no per-folder listing) and delete in batches
+    deleted = 0
+    paginator = default_storage.s3_connection.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': DELETE_BATCH_SIZE}):
+        keys = [{'Key': entry['Key']} for entry in page.get('Contents', ())]
+        if not keys:
+            continue
+
+        response = default_storage.s3_connection.delete_objects(Bucket=bucket, Delete={'Objects': keys, 'Quiet': True})
+        for error in response.get('Errors', ()):
+            print("Unable to delete '%s': %s" % (error['Key'], error['Message']))
+
+        deleted += len(keys) - len(response.get('Errors', ()))
+        _report_progress(path, deleted, verbose)
+
+    return deleted
+
+
+def _delfolder(path, verbose):
 
     # list folders and files
     (folders, files) = default_storage.listdir(path)
@@ -20,9 +167,35 @@ def delfolder(path):
         default_storage.delete(file_path)
 
     # now delete folders recursively
+    deleted = len(files)
     for folder in folders:
         folder_path = os.path.join(path, folder)
-        delfolder(folder_path)
+        deleted += _delfolder(folder_path, verbose)
+
+    if files:
+        _report_progress(path, deleted, verbose)
+
+    return deleted
+
+
+def delfolder(path, background=False, verbose=False):
+
+    # delete a folder with all its contents, optionally in a background thread (returned)
+    if background:
+        thread = threading.Thread(target=delfolder, args=(path, False, verbose), name="delfolder:%s" % path)
+        thread.start()
+        return thread
+
+    local_path = localpath(path)
+    if local_path is not None:
+        if not os.path.isdir(local_path):
+            return 0
+        return _delfolder_local(path, local_path, verbose)
+
+    if hasattr(default_storage, 's3_connection'):
+        return _delfolder_s3(path, verbose)
+
+    return _delfolder(path, verbose)
 
 
 def get_subfolders(path, intsort=False):
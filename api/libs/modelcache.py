@@ -0,0 +1,125 @@
+import os
+import fcntl
+import shutil
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from api.models import ModelCacheCounter, add_model_cache_counts
+
+from api.libs.filemanagement import localpath
+
+
+# Local disk cache of the models served by the server (MODEL_SERVING = 'cached'), shared by the workers of
+# a host. Models are stored by checksum (so they never go stale) and evicted in least recently used order
+# once the cache exceeds MODEL_CACHE_SIZE. Hits and misses are counted per process and added to counters in
+# the database from time to time (see the modelcachestats command).
+
+# counters are flushed to the database every this many requests (and on every miss)
+FLUSH_EVERY = 100
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(event):
+    with _stats_lock:
+        _stats[event] += 1
+        if event == 'hits' and _stats['hits'] + _stats['misses'] < FLUSH_EVERY:
+            return
+        counts = dict(_stats)
+        _stats['hits'] = _stats['misses'] = 0
+
+    add_model_cache_counts(counts)
+
+
+def get_stats():
+    stats = {'hits': 0, 'misses': 0}
+    stats.update(ModelCacheCounter.objects.values_list('name', 'count'))
+    return stats
+
+
+def reset_stats():
+    ModelCacheCounter.objects.all().delete()
+
+
+def _evict(keep):
+
+    # remove the least recently used models until the cache fits its size
+    entries = []
+    for name in os.listdir(settings.MODEL_CACHE_DIR):
+        path = os.path.join(settings.MODEL_CACHE_DIR, name)
+        if name.endswith('.bin') and path != keep:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    # (the kept model may have been evicted by another worker meanwhile)
+    total = sum(size for _, size, _ in entries)
+    try:
+        total += os.path.getsize(keep)
+    except FileNotFoundError:
+        pass
+
+    for _, size, path in sorted(entries):
+        if total <= settings.MODEL_CACHE_SIZE:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _load(storage_path, path):
+
+    # download into a temporary file first, so readers never see a partial model (removed if the download fails)
+    file = tempfile.NamedTemporaryFile(dir=settings.MODEL_CACHE_DIR, suffix='.tmp', delete=False)
+    try:
+        with file, default_storage.open(storage_path) as data:
+            shutil.copyfileobj(data, file, 1048576)
+        os.replace(file.name, path)
+
+    finally:
+        if os.path.exists(file.name):
+            os.remove(file.name)
+
+
+def open_model(storage_path, checksum):
+
+    # open (binary) file of a model, raises OSError if it doesn't exist
+
+    # local storage: the file itself
+    local_path = localpath(storage_path)
+    if local_path is not None:
+        return open(local_path, 'rb')
+
+    # (an open file stays readable even if the model is evicted meanwhile)
+    path = os.path.join(settings.MODEL_CACHE_DIR, checksum + '.bin')
+    try:
+        file = open(path, 'rb')
+        os.utime(path)
+        _count('hits')
+        return file
+    except FileNotFoundError:
+        pass
+
+    # load it once (concurrent requests, from any worker of the host, wait for it)
+    os.makedirs(settings.MODEL_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(settings.MODEL_CACHE_DIR, 'models.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if os.path.exists(path):
+            _count('hits')
+        else:
+            _load(storage_path, path)
+            _count('misses')
+
+        file = open(path, 'rb')
+
+    _evict(keep=path)
+    return file
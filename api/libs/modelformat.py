@@ -0,0 +1,227 @@
+import json
+import zlib
+import struct
+
+from collections import namedtuple
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for 'ZSTD' compression
+    zstandard = None
+
+
+# Model container (little endian):
+#   magic (4 bytes) | version (uint8) | header length (uint32) | header (JSON, utf-8) | payload
+# The header describes the payload: kind, element dtype, total size, tensor sizes (and int8 scales per tensor),
+# compression and a CRC32 checksum of the uncompressed payload. Raw float32 files (no magic) are still valid models.
+#
+# Kinds:
+#   'full': model weights
+#   'delta': difference from the model of the round (dense)
+#   'sparse': difference from the model of the round, only at the given indices (uint32 indices, then values)
+MAGIC = b'FLMW'
+VERSION = 1
+PREAMBLE = struct.Struct('<4sBI')
+
+DTYPES = {
+    'FLOAT32': np.dtype('<f4'),
+    'FLOAT16': np.dtype('<f2'),
+    'INT8': np.dtype('i1'),
+}
+
+COMPRESSIONS = ('NONE', 'DEFLATE', 'ZSTD')
+KINDS = ('full', 'delta', 'sparse')
+INDEX_DTYPE = np.dtype('<u4')
+
+# decoded container (indices only for sparse updates)
+Update = namedtuple('Update', ['kind', 'size', 'indices', 'values'])
+
+# errors raised while decoding malformed containers (reported as ValueError, like any other invalid container)
+DECODE_ERRORS = (struct.error, KeyError, IndexError, TypeError, AttributeError, zlib.error) + (
+    (zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def is_container(content):
+    return content[:len(MAGIC)] == MAGIC
+
+
+def is_raw(model_format, compression):
+    return model_format == 'FLOAT32' and compression == 'NONE'
+
+
+def _compress(payload, compression):
+    if compression == 'DEFLATE':
+        return zlib.compress(payload, 6)
+    if compression == 'ZSTD':
+        if zstandard is None:
+            raise ValueError("ZSTD compression requires the 'zstandard' package")
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    return payload
+
+
+def _decompress(payload, compression):
+    if compression == 'DEFLATE':
+        return zlib.decompress(payload)
+    if compression == 'ZSTD':
+        if zstandard is None:
+            raise ValueError("ZSTD compression requires the 'zstandard' package")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return payload
+
+
+def topk(delta, k):
+
+    # indices and values of the k largest (in magnitude) entries of a delta (for 'sparse' updates)
+    delta = np.asarray(delta, dtype=np.float32)
+    k = min(k, len(delta))
+    if k <= 0:
+        return np.empty(0, dtype=INDEX_DTYPE), np.empty(0, dtype=np.float32)
+
+    indices = np.sort(np.argpartition(np.abs(delta), len(delta) - k)[len(delta) - k:])
+    return indices, delta[indices]
+
+
+def encode(weights, model_format='FLOAT32', compression='NONE', tensors=None, kind='full', indices=None, size=None):
+
+    if model_format not in DTYPES:
+        raise ValueError("Unknown model format: %s" % model_format)
+    if compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression: %s" % compression)
+    if kind not in KINDS:
+        raise ValueError("Unknown update kind: %s" % kind)
+
+    weights = np.asarray(weights, dtype=np.float32)
+
+    # sparse updates carry the values of the given indices only (quantized as a single tensor)
+    if kind == 'sparse':
+        indices = np.asarray(indices, dtype=INDEX_DTYPE)
+        if len(indices) != len(weights):
+            raise ValueError("Sparse update has %d indices for %d values" % (len(indices), len(weights)))
+        if size is None:
+            raise ValueError("Sparse updates need the size of the model")
+        tensors = [len(weights)]
+    else:
+        size = len(weights)
+
+    tensors = list(tensors) if tensors else [len(weights)]
+    if sum(tensors) != len(weights):
+        raise ValueError("Tensor sizes (%d) don't match the number of weights (%d)" % (sum(tensors), len(weights)))
+
+    header = {
+        'kind': kind,
+        'dtype': model_format,
+        'size': size,
+        'tensors': tensors,
+        'compression': compression,
+    }
+
+    # symmetric per-tensor quantization
+    if model_format == 'INT8':
+        scales = []
+        quantized = np.empty(len(weights), dtype=DTYPES['INT8'])
+        offset = 0
+        for tensor_size in tensors:
+            tensor = weights[offset:offset + tensor_size]
+            scale = float(np.abs(tensor).max()) / 127 if tensor_size > 0 else 0.0
+            scales.append(scale)
+            quantized[offset:offset + tensor_size] = np.round(tensor / scale) if scale > 0 else 0
+            offset += tensor_size
+        header['scales'] = scales
+        payload = quantized.tobytes()
+    else:
+        payload = weights.astype(DTYPES[model_format]).tobytes()
+
+    if kind == 'sparse':
+        header['nnz'] = len(indices)
+        payload = indices.tobytes() + payload
+
+    header['checksum'] = zlib.crc32(payload)
+    payload = _compress(payload, compression)
+
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return PREAMBLE.pack(MAGIC, VERSION, len(header)) + header + payload
+
+
+def decode_header(content):
+
+    # header (a dict) of a model container and the offset of its payload, raises ValueError if malformed
+    try:
+        magic, version, header_length = PREAMBLE.unpack_from(content)
+    except struct.error as ex:
+        raise ValueError("Invalid model container: %s" % ex)
+
+    if magic != MAGIC:
+        raise ValueError("Not a model container")
+    if version != VERSION:
+        raise ValueError("Unsupported model container version: %d" % version)
+
+    start = PREAMBLE.size + header_length
+    header = json.loads(bytes(content[PREAMBLE.size:start]).decode('utf-8'))
+    if not isinstance(header, dict):
+        raise ValueError("Invalid model container header")
+
+    return header, start
+
+
+def decode_update(content):
+
+    # update (full model, delta or sparse delta) of a model container, with float32 values. Raises ValueError
+    # if the container is malformed
+    try:
+        return _decode_update(content)
+    except DECODE_ERRORS as ex:
+        raise ValueError("Invalid model container: %s: %s" % (type(ex).__name__, ex))
+
+
+def _decode_update(content):
+
+    header, start = decode_header(content)
+
+    if header['dtype'] not in DTYPES:
+        raise ValueError("Unknown model format: %s" % header['dtype'])
+
+    payload = _decompress(bytes(content[start:]), header['compression'])
+    if zlib.crc32(payload) != header['checksum']:
+        raise ValueError("Model container checksum mismatch")
+
+    kind = header.get('kind', 'full')
+    if kind not in KINDS:
+        raise ValueError("Unknown update kind: %s" % kind)
+
+    indices = None
+    count = header['size']
+    if kind == 'sparse':
+        count = header['nnz']
+        indices = np.frombuffer(payload, dtype=INDEX_DTYPE, count=count)
+        payload = payload[count * INDEX_DTYPE.itemsize:]
+
+    values = np.frombuffer(payload, dtype=DTYPES[header['dtype']])
+    if len(values) != count:
+        raise ValueError("Model container holds %d values instead of %d" % (len(values), count))
+
+    if header['dtype'] != 'INT8':
+        return Update(kind, header['size'], indices, values.astype(np.float32))
+
+    # dequantize per tensor
+    if sum(header['tensors']) != count or len(header['scales']) != len(header['tensors']):
+        raise ValueError("Model container tensors don't match its values")
+
+    weights = np.empty(len(values), dtype=np.float32)
+    offset = 0
+    for size, scale in zip(header['tensors'], header['scales']):
+        np.multiply(values[offset:offset + size], scale, out=weights[offset:offset + size], dtype=np.float32)
+        offset += size
+
+    return Update(kind, header['size'], indices, weights)
+
+
+def decode(content):
+
+    # float32 weights of a model container (full models only)
+    update = decode_update(content)
+    if update.kind != 'full':
+        raise ValueError("Model container holds a '%s' update instead of a full model" % update.kind)
+
+    return update.values
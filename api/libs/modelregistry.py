@@ -0,0 +1,91 @@
+import os
+import json
+import threading
+
+from collections import namedtuple
+
+import numpy as np
+
+from django.core.files.storage import default_storage
+
+from api.libs import consts
+
+
+# Metadata of a model, stored alongside its initial weights (models/<name>.bin, float32) as models/<name>.json:
+#   {"layers": [{"name": "conv1/kernel", "shape": [3, 3, 3, 32]}, ...]}
+# Models without metadata are considered a single flat layer with the size of their initial weights.
+ModelSpec = namedtuple('ModelSpec', ['name', 'layers', 'size'])
+Layer = namedtuple('Layer', ['name', 'shape', 'size'])
+
+_specs = {}
+_specs_lock = threading.Lock()
+
+
+def model_file(name):
+    return os.path.join(consts.MODELS_PATH, name + '.bin')
+
+
+def metadata_file(name):
+    return os.path.join(consts.MODELS_PATH, name + '.json')
+
+
+def _load_layers(data):
+
+    # layers of the metadata of a model, raises ValueError if malformed
+    try:
+        layers = []
+        for layer in json.load(data)['layers']:
+            shape = tuple(int(dimension) for dimension in layer['shape'])
+            if not shape or min(shape) <= 0:
+                raise ValueError("invalid shape %s" % (shape,))
+            layers.append(Layer(str(layer.get('name', len(layers))), shape, int(np.prod(shape))))
+
+    except (KeyError, TypeError, AttributeError) as ex:
+        raise ValueError("missing or malformed field %s" % ex)
+
+    if not layers:
+        raise ValueError("no layers")
+
+    return layers
+
+
+def _load_spec(name):
+
+    # raises ValueError (naming the model) if its initial weights are missing or don't match its metadata
+    try:
+        weights_size = default_storage.size(model_file(name))
+    except (OSError, IOError) as ex:
+        raise ValueError("Initial weights of model '%s' are not available: %s" % (name, ex))
+
+    try:
+        with default_storage.open(metadata_file(name)) as data:
+            layers = _load_layers(data)
+
+    except (OSError, IOError):
+
+        # no metadata, derive the size from the initial weights
+        size = weights_size // np.dtype(np.float32).itemsize
+        return ModelSpec(name, [Layer('weights', (size,), size)], size)
+
+    except ValueError as ex:
+        raise ValueError("Invalid metadata of model '%s': %s" % (name, ex))
+
+    size = sum(layer.size for layer in layers)
+    if size * np.dtype(np.float32).itemsize != weights_size:
+        raise ValueError("Initial weights of model '%s' don't match its layers (%d bytes, %d weights)" % (name, weights_size, size))
+
+    return ModelSpec(name, layers, size)
+
+
+def get_spec(name):
+
+    # cached in-process (model metadata never changes while a server is running)
+    with _specs_lock:
+        if name not in _specs:
+            _specs[name] = _load_spec(name)
+        return _specs[name]
+
+
+def clear_cache():
+    with _specs_lock:
+        _specs.clear()
@@ -1,77 +1,91 @@
 import os
 import json
 
-from urllib.request import urlopen, Request
+import urllib3
+
+from django.conf import settings
 
 PW_AUTH = os.environ['PUSHWOOSH_API_TOKEN']
 PW_APPLICATION_CODE = os.environ['PUSHWOOSH_APPLICATION_CODE']
 
+# pooled connections to the provider (shared by the threads sending messages, see api/push_outbox.py)
+_http = urllib3.PoolManager(maxsize=settings.PUSH_WORKERS, retries=False)
+
+
+class PushError(Exception):
+
+    # retryable if the provider may accept the request later (timeouts, connection and server errors)
+    def __init__(self, message, retryable):
+        super().__init__(message)
+        self.retryable = retryable
+
 
 def _pw_call(method, data, verbose=False):
-    url = 'https://cp.pushwoosh.com/json/1.3/' + method
+
+    # returns the response of the provider, raises PushError
+    url = settings.PUSHWOOSH_API_URL + method
     data = json.dumps({'request': data})
-    req = Request(url, data.encode('UTF-8'), {'Content-Type': 'application/json'})
     try:
-        f = urlopen(req)
-        response = json.loads(f.read())
-        f.close()
+        r = _http.request(
+            'POST', url,
+            body=data.encode('UTF-8'),
+            headers={'Content-Type': 'application/json'},
+            timeout=urllib3.Timeout(total=settings.PUSH_TIMEOUT))
 
-        if response['status_code'] == 200:
-            verbose and print('Push sent succesfully.')
-        else:
-            verbose and print('Pushwoosh request' + str(data))
-            verbose and print('Pushwoosh response: ' + str(response))
+    except urllib3.exceptions.HTTPError as e:
+        raise PushError('Unable to send the Pushwoosh request. ' + str(e), retryable=True)
 
-    except Exception as e:
-        print('Error: Unable to send the Pushwoosh request. ' + str(e))
+    if r.status >= 500 or r.status == 429:
+        raise PushError('Pushwoosh is unavailable (HTTP status %d).' % r.status, retryable=True)
 
+    try:
+        response = json.loads(r.data)
+    except ValueError:
+        raise PushError('Invalid Pushwoosh response (HTTP status %d).' % r.status, retryable=False)
 
-def send_data(users, data, ttl_mins, verbose=False):
+    if response.get('status_code') != 200:
+        verbose and print('Pushwoosh request' + str(data))
+        verbose and print('Pushwoosh response: ' + str(response))
+        raise PushError('Pushwoosh response: ' + str(response), retryable=False)
 
-    if len(users) == 0:
-        print("Error: Tried to push data to an empty list of users.")
-        return
+    verbose and print('Push sent succesfully.')
+    return response
 
-    _pw_call('createMessage', {
+
+def create_message(notification, users, verbose=False):
+
+    # send a notification to the given users (at most PUSH_BATCH_SIZE)
+    notification = dict(notification, users=users)
+
+    return _pw_call('createMessage', {
         'auth': PW_AUTH,
         'application': PW_APPLICATION_CODE,
-        'notifications': [
-            {
-                'send_date': 'now',
-                "ignore_user_timezone": True,
-                'data': data,
-                'users': users,
-                "ios_silent": 1,
-                "android_silent": 1,
-                "ios_ttl": ttl_mins * 60,
-                "android_gcm_ttl": ttl_mins * 60,
-            }
-        ]
+        'notifications': [notification]
     }, verbose)
 
 
-def send_notification(users, send_date, header, content, ttl_mins=1440, verbose=False):
+def data_notification(data, ttl_mins):
+    return {
+        'send_date': 'now',
+        "ignore_user_timezone": True,
+        'data': data,
+        "ios_silent": 1,
+        "android_silent": 1,
+        "ios_ttl": ttl_mins * 60,
+        "android_gcm_ttl": ttl_mins * 60,
+    }
 
-    if len(users) == 0:
-        print("Error: Tried to push data to an empty list of users.")
-        return
 
-    _pw_call('createMessage', {
-        'auth': PW_AUTH,
-        'application': PW_APPLICATION_CODE,
-        'notifications': [
-            {
-                "send_date": send_date.strftime("%Y-%m-%d %H:%M"),
-                "ignore_user_timezone": False,
-                "users": users,
-                "ios_ttl": ttl_mins * 60,
-                "android_gcm_ttl": ttl_mins * 60,
-                "android_header": header,
-                "ios_title": header,
-                "content": content,
-                "android_priority": 0,
-                "android_delivery_priority": "high",
-                "android_custom_icon": "https://minoskt.github.io/download/flaas_large_icon.png",
-            }
-        ]
-    }, verbose)
+def text_notification(send_date, header, content, ttl_mins=1440):
+    return {
+        "send_date": send_date.strftime("%Y-%m-%d %H:%M"),
+        "ignore_user_timezone": False,
+        "ios_ttl": ttl_mins * 60,
+        "android_gcm_ttl": ttl_mins * 60,
+        "android_header": header,
+        "ios_title": header,
+        "content": content,
+        "android_priority": 0,
+        "android_delivery_priority": "high",
+        "android_custom_icon": "https://minoskt.github.io/download/flaas_large_icon.png",
+    }
@@ -0,0 +1,74 @@
+import re
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+
+    # (start, end) of a single byte range (end inclusive). None if there is no usable range (the whole
+    # file is sent), False if the range can't be satisfied.
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+
+    start, end = match.groups()
+
+    # last bytes of the file
+    if not start:
+        if not end:
+            return None
+        if int(end) == 0:
+            return False
+        return max(0, size - int(end)), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or end < start:
+        return False
+
+    return start, end
+
+
+def _read_range(data, start, length, chunk_size=65536):
+    try:
+        data.seek(start)
+        while length > 0:
+            chunk = data.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+    finally:
+        data.close()
+
+
+def file_response(request, data, size, etag=None, filename=None):
+
+    # full or partial (HTTP Range, for resumable downloads) response of an open file, which is closed once sent
+    byte_range = None
+    if 'HTTP_RANGE' in request.META and request.META.get('HTTP_IF_RANGE', etag) == etag:
+        byte_range = parse_range(request.META['HTTP_RANGE'], size)
+
+    if byte_range is False:
+        data.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+
+    elif byte_range is None:
+        response = FileResponse(data, as_attachment=True, filename=filename, content_type='application/octet-stream')
+
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(_read_range(data, start, end - start + 1), status=206, content_type='application/octet-stream')
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+
+    response['Accept-Ranges'] = 'bytes'
+    if etag:
+        response['ETag'] = etag
+
+    return response
@@ -0,0 +1,101 @@
+import shutil
+import hashlib
+import tempfile
+
+from django.conf import settings
+from django.core import signing
+from django.core.files import File
+from django.urls import reverse
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+from rest_framework.exceptions import ParseError
+
+from api.libs.filemanagement import filereplace
+from api.libs import modelformat
+
+
+# salt of the tokens of local upload urls (stand-in for presigned urls when the storage is not S3)
+UPLOAD_SALT = 'api.upload'
+
+# model weights are uploaded under a staging name, so the previous model of the device is
+# still available when the upload completes (see server_control.fold_model)
+STAGING_SUFFIX = '.upload'
+
+
+def upload_url(request, path, content_type):
+
+    # S3: presigned PUT url (the file goes straight to the bucket)
+    if hasattr(default_storage, 's3_connection'):
+        return default_storage.s3_connection.generate_presigned_url(
+            'put_object',
+            Params={
+                'Bucket': default_storage.settings.AWS_S3_BUCKET_NAME,
+                'Key': default_storage._get_key_name(path),
+                'ContentType': content_type,
+            },
+            ExpiresIn=settings.UPLOAD_URL_EXPIRY)
+
+    # otherwise: signed url of the local upload view
+    token = signing.dumps(path, salt=UPLOAD_SALT)
+    return request.build_absolute_uri(reverse('local-upload', args=[token]))
+
+
+def upload_path(token):
+
+    # path of a local upload url (raises signing.BadSignature if invalid or expired)
+    return signing.loads(token, salt=UPLOAD_SALT, max_age=settings.UPLOAD_URL_EXPIRY)
+
+
+def save_stream(path, stream, chunk_size=1048576):
+
+    # save a request body without holding it in memory (spooled to disk above chunk_size)
+    with tempfile.SpooledTemporaryFile(max_size=chunk_size) as buffer:
+        shutil.copyfileobj(stream, buffer, chunk_size)
+        buffer.seek(0)
+        return filereplace(path, File(buffer))
+
+
+class ModelUploadHandler(TemporaryFileUploadHandler):
+
+    # streams an uploaded model to a temporary file (memory stays constant regardless of the model size),
+    # computing its checksum and length on the fly. With the expected size of raw float32 weights (in bytes),
+    # uploads of a different size are rejected as soon as that is known.
+
+    # raw weights (or their sparse updates, with indices) and room for the container header
+    CONTAINER_OVERHEAD = 1048576
+
+    def __init__(self, request=None, expected_size=None):
+        super().__init__(request)
+        self.expected_size = expected_size
+
+    def _reject(self, length):
+        raise ParseError("Model has incorrect length: %d bytes (expected %d)" % (length, self.expected_size))
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if self.expected_size and content_length and content_length > 2 * self.expected_size + self.CONTAINER_OVERHEAD:
+            self._reject(content_length)
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.checksum = hashlib.sha1()
+        self.container = None
+
+    def receive_data_chunk(self, raw_data, start):
+
+        # raw weights must match the expected size exactly (containers are validated when decoded)
+        if self.container is None:
+            self.container = modelformat.is_container(raw_data)
+        if self.expected_size and not self.container and start + len(raw_data) > self.expected_size:
+            self._reject(start + len(raw_data))
+
+        self.checksum.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        if self.expected_size and not self.container and file_size != self.expected_size:
+            self._reject(file_size)
+
+        file = super().file_complete(file_size)
+        file.checksum = self.checksum.hexdigest()
+        return file
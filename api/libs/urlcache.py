@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+
+
+# missing files are cached briefly (so a model that is about to be written is soon found)
+MISS_TIMEOUT = 30
+
+
+def model_key(project_id, round):
+
+    # rounds are numbers ('05' is round 5), raises ValueError otherwise
+    return 'url:model:%s:%d' % (project_id, int(round))
+
+
+def etag_key(project_id, round):
+    return 'etag:model:%s:%d' % (project_id, int(round))
+
+
+def samples_key(dataset_type, samples_index, app):
+    return 'url:samples:%s:%s:%s' % (dataset_type, samples_index, app)
+
+
+def apps_key(dataset_type, samples_index):
+    return 'url:apps:%s:%s' % (dataset_type, samples_index)
+
+
+def cached(key, compute):
+
+    # value given by compute() (None if unavailable), cached across workers for less than the url
+    # expiry, so most requests need no database or storage round-trips
+    value = cache.get(key)
+    if value is None:
+        value = compute() or ''
+        cache.set(key, value, settings.URL_CACHE_TIMEOUT if value else MISS_TIMEOUT)
+
+    return value or None
+
+
+def _url(path):
+    if path is not None and default_storage.exists(path):
+        return default_storage.url(path)
+    return None
+
+
+def cached_url(key, resolve):
+
+    # signed url of the file at the path given by resolve() (None if it doesn't exist)
+    return cached(key, lambda: _url(resolve()))
+
+
+def cached_listdir(key, path):
+
+    # folders at path (cached as urls are)
+    folders = cache.get(key)
+    if folders is None:
+        try:
+            folders, _ = default_storage.listdir(path)
+        except (OSError, IOError):
+            folders = []
+        cache.set(key, folders, settings.URL_CACHE_TIMEOUT if folders else MISS_TIMEOUT)
+
+    return folders
+
+
+def forget_model(project_id, round_number):
+
+    # the model of a round was written (or referenced)
+    forget_models(project_id, [round_number])
+
+
+def forget_models(project_id, round_numbers):
+
+    # the models of the rounds were written or deleted
+    cache.delete_many([key(project_id, round_number) for round_number in round_numbers for key in (model_key, etag_key)])
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api import retention
+
+
+class Command(BaseCommand):
+    help = 'Roll up, archive and delete the device pings older than their retention period (STATUS_RETENTION_DAYS or per project).'
+
+    def add_arguments(self, parser):
+
+        # optional
+        parser.add_argument('--batch-size', nargs='?', type=int, default=None, help="Number of pings processed per batch (default: STATUS_RETENTION_BATCH_SIZE).")
+        parser.add_argument('--max-batches', nargs='?', type=int, default=None, help="Stop after this many batches (default: all expired pings).")
+        parser.add_argument('--no-archive', action='store_true', help="Delete the pings without archiving them into the storage.")
+
+    def handle(self, *args, **options):
+        archive = False if options['no_archive'] else None
+        retention.apply(options['batch_size'], options['max_batches'], archive, verbose=True)
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from api.models import DeviceStatusResponse, device_status_fields
+
+
+class Command(BaseCommand):
+    help = 'Fill the typed columns (power_plugged, battery_level, network_type, standby_bucket) of device status responses stored before they existed.'
+
+    def add_arguments(self, parser):
+
+        # optional
+        parser.add_argument('--batch-size', nargs='?', type=int, default=5000, help="Number of responses updated per batch.")
+
+    def handle(self, *args, **options):
+
+        batch_size = options['batch_size']
+        fields = ['power_plugged', 'battery_level', 'network_type', 'standby_bucket']
+
+        # responses without any typed field (new responses are filled on ingest)
+        responses = DeviceStatusResponse.objects.filter(
+            power_plugged__isnull=True,
+            battery_level__isnull=True,
+            network_type__isnull=True,
+            standby_bucket__isnull=True).only('id', 'data').order_by('id')
+
+        # walk through them by id (in batches, so memory and transactions stay small)
+        last_id = 0
+        updated = 0
+        while True:
+            batch = list(responses.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+
+            for response in batch:
+                for field, value in device_status_fields(response.data if isinstance(response.data, dict) else {}).items():
+                    setattr(response, field, value)
+
+            DeviceStatusResponse.objects.bulk_update(batch, fields)
+            last_id = batch[-1].id
+            updated += len(batch)
+            print("Updated %d responses (up to id %d)." % (updated, last_id))
+
+        print("Done: %d responses updated." % updated)
@@ -0,0 +1,86 @@
+import json
+import time
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, AsyncClient
+
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+class Command(BaseCommand):
+    help = 'Compare the throughput of a device-facing endpoint served through WSGI (sync views) and ASGI (async views).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', nargs=1, type=str, help="User whose device issues the requests.")
+
+        # optional
+        parser.add_argument('--endpoint', nargs='?', type=str, default='get-model', choices=['get-model', 'get-samples', 'join-round', 'report-availability'], help="Endpoint to benchmark (note that 'join-round' and 'report-availability' write to the database).")
+        parser.add_argument('--project', nargs='?', type=int, default=1, help="Project ID (get-model and join-round).")
+        parser.add_argument('--round', nargs='?', type=str, default='0', help="Round (get-model and join-round).")
+        parser.add_argument('--requests', nargs='?', type=int, default=1000, help="Number of requests.")
+        parser.add_argument('--concurrency', nargs='?', type=int, default=50, help="Number of concurrent requests.")
+
+    def handle(self, *args, **options):
+
+        try:
+            user = User.objects.get(username=options['username'][0])
+        except User.DoesNotExist:
+            raise CommandError("User '%s' does not exist." % options['username'][0])
+
+        token = str(RefreshToken.for_user(user).access_token)
+        method, url, data = self.__request(user, options)
+
+        print("%s %s: %d requests, %d concurrent" % (method.upper(), url, options['requests'], options['concurrency']))
+        for name, benchmark in (('WSGI', self.__wsgi), ('ASGI', self.__asgi)):
+            start = time.perf_counter()
+            codes = benchmark(method, url, data, token, options['requests'], options['concurrency'])
+            elapsed = time.perf_counter() - start
+            print("%s: %.1f requests/s (%.2fs, status codes: %s)" % (name, len(codes) / elapsed, elapsed, dict((code, codes.count(code)) for code in set(codes))))
+
+    def __request(self, user, options):
+
+        if options['endpoint'] == 'get-model':
+            return 'get', '/api/project/%d/get-model/%s/' % (options['project'], options['round']), None
+
+        if options['endpoint'] == 'join-round':
+            return 'get', '/api/project/%d/join-round/%s/' % (options['project'], options['round']), None
+
+        if options['endpoint'] == 'get-samples':
+            dataset_type = user.profile.project.dataset_type if user.profile.project else 'IID'
+            return 'get', '/api/get-samples/%s/0/' % dataset_type, None
+
+        data = {
+            'request_type': 'device-ping',
+            'device_info': {'device_details': {'model': 'benchmark', 'os': 'Android'}},
+        }
+        return 'post', '/api/report-availability', json.dumps(data)
+
+    def __wsgi(self, method, url, data, token, requests, concurrency):
+
+        def request(_):
+            client = Client()
+            kwargs = {'data': data, 'content_type': 'application/json'} if data else {}
+            return getattr(client, method)(url, HTTP_AUTHORIZATION='Bearer ' + token, **kwargs).status_code
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(request, range(requests)))
+
+    def __asgi(self, method, url, data, token, requests, concurrency):
+
+        async def run():
+            client = AsyncClient()
+            semaphore = asyncio.Semaphore(concurrency)
+            kwargs = {'data': data, 'content_type': 'application/json'} if data else {}
+
+            async def request():
+                async with semaphore:
+                    response = await getattr(client, method)(url, authorization='Bearer ' + token, **kwargs)
+                    return response.status_code
+
+            return await asyncio.gather(*(request() for _ in range(requests)))
+
+        return asyncio.run(run())
@@ -53,11 +53,11 @@ class Command(BaseCommand):
         if power_plugged_only:
 
             # power plugged only
-            responses = responses.filter(data__battery_status__power_plugged=True)
+            responses = responses.filter(power_plugged=True)
 
         else:
 
             # power plugged OR > battery_level_threshold
-            responses = responses.filter(Q(data__battery_status__power_plugged=True) | Q(data__battery_status__level__gte=battery_level_threshold))
+            responses = responses.filter(Q(power_plugged=True) | Q(battery_level__gte=battery_level_threshold))
 
         return responses
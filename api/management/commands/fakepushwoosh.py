@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from api.libs.fakepushwoosh import FakePushwoosh
+
+
+class Command(BaseCommand):
+    help = 'Run a local fake of the Pushwoosh API (point PUSHWOOSH_API_URL to it), for tests and load runs.'
+
+    def add_arguments(self, parser):
+
+        # optional
+        parser.add_argument('--port', nargs='?', type=int, default=8001, help="Port to listen to.")
+        parser.add_argument('--delay', nargs='?', type=float, default=0.0, help="Seconds before answering each request.")
+        parser.add_argument('--failures', nargs='?', type=int, default=0, help="Number of requests to fail (HTTP 500) first.")
+
+    def handle(self, *args, **options):
+
+        server = FakePushwoosh(port=options['port'], delay=options['delay'], failures=options['failures'], verbose=True)
+        print("Fake Pushwoosh API at %s (set PUSHWOOSH_API_URL to it)." % server.url)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+        users = sum(len(notification['users']) for _, request in server.requests for notification in request['notifications'])
+        print("Accepted %d requests (%d users)." % (len(server.requests), users))
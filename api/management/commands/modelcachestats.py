@@ -0,0 +1,32 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.libs import modelcache
+
+
+class Command(BaseCommand):
+    help = 'Report hits and misses of the local model cache (MODEL_SERVING = cached).'
+
+    def add_arguments(self, parser):
+
+        # optional
+        parser.add_argument('--reset', action='store_true', help="Reset the counters after reporting.")
+
+    def handle(self, *args, **options):
+
+        stats = modelcache.get_stats()
+        requests = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / requests if requests else 0.0
+
+        print("Requests: %d, hits: %d, misses: %d, hit rate: %.2f%%" % (requests, stats['hits'], stats['misses'], 100 * hit_rate))
+
+        # contents of the cache on this host
+        if os.path.isdir(settings.MODEL_CACHE_DIR):
+            sizes = [os.path.getsize(os.path.join(settings.MODEL_CACHE_DIR, name)) for name in os.listdir(settings.MODEL_CACHE_DIR) if name.endswith('.bin')]
+            print("Cached models: %d (%.1f of %.1f MB)" % (len(sizes), sum(sizes) / 2 ** 20, settings.MODEL_CACHE_SIZE / 2 ** 20))
+
+        if options['reset']:
+            modelcache.reset_stats()
+            print("Counters reset.")
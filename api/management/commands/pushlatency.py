@@ -0,0 +1,42 @@
+import numpy as np
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Project, TrainRequestDelivery
+
+
+class Command(BaseCommand):
+    help = 'Report the delivery of the train requests of a project: acknowledgement rate and push-to-ack latency percentiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('project', nargs=1, type=int, help="Project ID")
+
+        # optional
+        parser.add_argument('--round', nargs='?', type=int, default=None, help="Only this round.")
+
+    def handle(self, *args, **options):
+
+        # get project
+        try:
+            project = Project.objects.get(id=options['project'][0])
+        except Project.DoesNotExist:
+            raise CommandError("Project with id '%d' does not exist." % options['project'][0])
+
+        deliveries = TrainRequestDelivery.objects.filter(train_request__round__project=project)
+        if options['round'] is not None:
+            deliveries = deliveries.filter(train_request__round__round_number=options['round'])
+
+        deliveries = list(deliveries.values_list('pushes', 'sent_date', 'ack_date'))
+        sent = [(pushes, sent_date, ack_date) for pushes, sent_date, ack_date in deliveries if sent_date is not None]
+        acked = [(pushes, (ack_date - sent_date).total_seconds()) for pushes, sent_date, ack_date in sent if ack_date is not None]
+
+        print("Project '%s'" % project.title)
+        print("Pushed devices: %d, sent: %d, acknowledged: %d" % (len(deliveries), len(sent), len(acked)))
+        if not acked:
+            return
+
+        print("Acknowledged: %.2f%% (%d after pushing again)" % (100 * len(acked) / len(deliveries), sum(1 for pushes, _ in acked if pushes > 1)))
+
+        latencies = np.array([max(latency, 0.0) for _, latency in acked])
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print("Push-to-ack latency (seconds): p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" % (p50, p90, p99, latencies.max()))
@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from api import scheduling
+from api import push_questionnaire
+from api import retention
+from api import push_outbox
+
+
+class Command(BaseCommand):
+    help = 'Run the scheduler as a daemon (instead of a periodic tick), checking each project at its next deadline or as soon as one of its devices responds.'
+
+    def add_arguments(self, parser):
+
+        # optional
+        parser.add_argument('--poll-interval', nargs='?', type=float, default=settings.SCHEDULER_POLL_INTERVAL, help="Seconds between polls for scheduler events.")
+
+    def handle(self, *args, **options):
+
+        poll_interval = options['poll_interval']
+        daemon = scheduling.Daemon(poll_interval)
+        next_maintenance = timezone.now()
+
+        print("Scheduler started (polling events every %.1fs)." % poll_interval)
+
+        # send the push notifications left queued (and the ones queued from now on)
+        push_outbox.start()
+
+        while True:
+
+            # don't keep a broken connection around
+            close_old_connections()
+            now = timezone.now()
+
+            # check the projects that are due
+            timeout = daemon.poll(verbose=True)
+
+            # the rest of the tick
+            if now >= next_maintenance:
+                push_questionnaire.tick(verbose=True)
+                retention.tick(verbose=True)
+                next_maintenance = now + timedelta(seconds=settings.SCHEDULER_MAINTENANCE_INTERVAL)
+
+            # sleep until the next poll (or an earlier deadline, or a check is done)
+            daemon.wait(timeout)
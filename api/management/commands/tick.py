@@ -1,6 +1,8 @@
 from django.core.management.base import BaseCommand  # , CommandError
 from api import scheduling
 from api import push_questionnaire
+from api import retention
+from api import push_outbox
 
 
 class Command(BaseCommand):
@@ -9,3 +11,7 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         scheduling.tick(verbose=True)
         push_questionnaire.tick(verbose=True)
+        retention.tick(verbose=True)
+
+        # send the queued push notifications before exiting
+        push_outbox.close(verbose=True)
@@ -0,0 +1,251 @@
+import io
+import os
+import json
+import time
+import tempfile
+
+import numpy as np
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from api.mlmodel import MLModel, WEIGHTS_DTYPE, mapfile, decodefile
+from api.libs.filemanagement import fetchfiles, filereplace
+from api.libs import consts, modelregistry
+
+
+class FedAvg:
+
+    # the running sum kept while training (see server_control.fold_model) can replace aggregate()
+    incremental = True
+
+    def __init__(self, project):
+        self.project = project
+        self.spec = modelregistry.get_spec(project.model)
+
+    def _fetch(self, round, device_ids, verbose=False):
+
+        # round level
+        round_path = os.path.join(consts.PROJECTS_PATH, str(round.project_id), str(round.round_number))
+        file_paths = {os.path.join(round_path, str(device_id), consts.MODEL_WEIGHTS_FILENAME): device_id for device_id in device_ids}
+
+        # fetch device models concurrently and hand them over as they arrive
+        start = time.perf_counter()
+        fetch_times = []
+        for file_path, data, elapsed in fetchfiles(file_paths.keys(), settings.AGGREGATION_FETCH_WORKERS):
+            fetch_times.append(elapsed)
+            if data is not None:
+                with data:
+                    yield file_paths[file_path], data
+
+        if verbose and fetch_times:
+            print("Fetched %d device models in %.2fs (per model: mean %.2fs, max %.2fs)." % (
+                len(fetch_times), time.perf_counter() - start, np.mean(fetch_times), np.max(fetch_times)))
+
+    def aggregate(self, round, device_ids, base_path, verbose=False):
+
+        # init model with zeros (to append weights during aggregation, streamed in chunks per device)
+        model = MLModel.from_spec(self.spec)
+
+        for device_id, data in self._fetch(round, device_ids, verbose):
+            model.accumulate_file(data)
+
+        # None if no device model is usable (e.g. all invalid) or if the updates relative to the base model can't be resolved (the round keeps its model)
+        if model.devices == 0 or not model.resolve_deltas(base_path):
+            return None
+
+        model.aggregate()
+        return model
+
+    def update(self, model, global_model_path, verbose=False):
+
+        # server-side step on the aggregated model (none for plain averaging)
+        return model
+
+
+class WeightedFedAvg(FedAvg):
+
+    # weights are only known once all devices have reported
+    incremental = False
+
+    def _samples(self, round, device_id):
+
+        # number of training samples reported by the device in performance.json (if any)
+        file_path = os.path.join(consts.PROJECTS_PATH, str(round.project_id), str(round.round_number), str(device_id), consts.PERFORMANCE_FILENAME)
+        try:
+            with default_storage.open(file_path) as data:
+                samples = json.load(data).get('number_of_samples')
+                if samples is not None and float(samples) > 0:
+                    return float(samples)
+
+        except (OSError, IOError, ValueError, AttributeError):
+            pass
+
+        # otherwise, the number of samples that the device was asked to train with
+        return float(round.number_of_samples * round.number_of_apps)
+
+    def aggregate(self, round, device_ids, base_path, verbose=False):
+
+        model = MLModel.from_spec(self.spec)
+
+        for device_id, data in self._fetch(round, device_ids, verbose):
+            model.accumulate_file(data, self._samples(round, device_id))
+
+        if model.devices == 0 or not model.resolve_deltas(base_path):
+            return None
+
+        model.aggregate()
+        return model
+
+
+class Median(FedAvg):
+
+    # needs all device models at once
+    incremental = False
+
+    def _stack(self, round, device_ids, base_path, verbose=False):
+
+        # stack the device models into a (devices x weights) matrix, memory-mapped on local disk
+        buffer = tempfile.TemporaryFile()
+        matrix = np.memmap(buffer, dtype=WEIGHTS_DTYPE, mode='w+', shape=(max(1, len(device_ids)), self.spec.size))
+
+        base = None
+        rows = 0
+        for device_id, data in self._fetch(round, device_ids, verbose):
+            try:
+                update = decodefile(data)
+            except ValueError as ex:
+                print("Ignoring invalid model container: %s" % ex)
+                continue
+
+            # raw float32 weights
+            if update is None:
+                if data.size != self.spec.size * WEIGHTS_DTYPE.itemsize:
+                    print("Ignoring weights with incorrect length: %d" % (data.size // WEIGHTS_DTYPE.itemsize))
+                    continue
+
+                mapped = mapfile(data)
+                matrix[rows] = mapped if mapped is not None else np.frombuffer(data.read(), dtype=WEIGHTS_DTYPE)
+                rows += 1
+                continue
+
+            # updates relative to the base model are expanded into full models
+            row = MLModel.from_spec(self.spec, dtype=WEIGHTS_DTYPE)
+            if not row.accumulate_update(update):
+                continue
+
+            if row.deltas:
+                if base is None:
+                    base = MLModel.from_spec(self.spec, dtype=WEIGHTS_DTYPE)
+                    if not base.read(base_path):
+                        print("Base model is not available, ignoring the device updates.")
+                        base = False
+                if base is False:
+                    continue
+                row.weights += base.weights
+
+            matrix[rows] = row.weights
+            rows += 1
+
+        return matrix[:rows]
+
+    def _reduce(self, block):
+        return np.median(block, axis=0)
+
+    def aggregate(self, round, device_ids, base_path, verbose=False):
+
+        model = MLModel.from_spec(self.spec)
+
+        # None if no device model is usable (the round keeps its model)
+        matrix = self._stack(round, device_ids, base_path, verbose)
+        if len(matrix) == 0:
+            return None
+
+        # reduce column blocks, so memory is bounded by the chunk size (not by the number of devices)
+        columns = max(1, model.chunk_size // (WEIGHTS_DTYPE.itemsize * len(matrix)))
+        for start in range(0, self.spec.size, columns):
+            model.weights[start:start + columns] = self._reduce(np.asarray(matrix[:, start:start + columns]))
+
+        return model
+
+
+class TrimmedMean(Median):
+
+    def _reduce(self, block):
+
+        # drop the trim_ratio largest and smallest values of each coordinate
+        devices = len(block)
+        trimmed = min(int(float(self.project.trim_ratio) * devices), (devices - 1) // 2)
+        block = np.sort(block, axis=0)
+        return block[trimmed:devices - trimmed].mean(axis=0)
+
+
+class FedAdam(FedAvg):
+
+    def _second_moment(self, v, delta_sq, beta2):
+        return beta2 * v + (1 - beta2) * delta_sq
+
+    def update(self, model, global_model_path, verbose=False):
+
+        project = self.project
+
+        # current global model
+        global_model = MLModel.from_spec(self.spec)
+        if not global_model.read(global_model_path):
+            print("Global model is not available, skipping the server optimizer step.")
+            return model
+
+        # optimizer state is kept per project (so it survives invalid rounds)
+        state_path = os.path.join(consts.PROJECTS_PATH, str(project.id), consts.OPTIMIZER_STATE_FILENAME)
+        m, v = self._read_state(state_path, project.server_tau)
+
+        # pseudo-gradient (averaged device models minus current global model)
+        delta = model.weights - global_model.weights
+        m = project.server_beta1 * m + (1 - project.server_beta1) * delta
+        v = self._second_moment(v, np.square(delta), project.server_beta2)
+
+        model.weights = global_model.weights + project.server_learning_rate * m / (np.sqrt(v) + project.server_tau)
+
+        self._write_state(state_path, m, v)
+        verbose and print("Applied %s server step (learning rate: %g)." % (type(self).__name__, project.server_learning_rate))
+
+        return model
+
+    def _read_state(self, state_path, tau):
+
+        try:
+            with default_storage.open(state_path) as data:
+                state = np.load(io.BytesIO(data.read()))
+                if len(state['m']) == self.spec.size:
+                    return state['m'], state['v']
+
+        except (OSError, IOError, ValueError, KeyError):
+            pass
+
+        return np.zeros(self.spec.size), np.full(self.spec.size, tau ** 2)
+
+    def _write_state(self, state_path, m, v):
+        content = io.BytesIO()
+        np.savez(content, m=m, v=v)
+        filereplace(state_path, ContentFile(content.getvalue()))
+
+
+class FedYogi(FedAdam):
+
+    def _second_moment(self, v, delta_sq, beta2):
+        return v - (1 - beta2) * delta_sq * np.sign(v - delta_sq)
+
+
+AGGREGATORS = {
+    'FEDAVG': FedAvg,
+    'WEIGHTED_FEDAVG': WeightedFedAvg,
+    'TRIMMED_MEAN': TrimmedMean,
+    'MEDIAN': Median,
+    'FEDADAM': FedAdam,
+    'FEDYOGI': FedYogi,
+}
+
+
+def get_aggregator(project):
+    return AGGREGATORS[project.aggregation_strategy](project)
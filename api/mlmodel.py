@@ -1,41 +1,214 @@
+import io
+import os
+import hashlib
+
 import numpy as np
 
+from django.conf import settings
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 
+from api.libs.filemanagement import filereplace, localpath
+from api.libs import modelformat, modelregistry
+
+
+# weights are always exchanged with the devices as float32
+WEIGHTS_DTYPE = np.dtype(np.float32)
+
+
+def mapfile(data, dtype=WEIGHTS_DTYPE):
+
+    # memory-map a file opened from a local filesystem storage (None for any other storage)
+    if data.size == 0 or not isinstance(getattr(data, 'file', None), io.BufferedReader):
+        return None
+
+    return np.memmap(data.file, dtype=dtype, mode='r')
+
+
+def decodefile(data):
+
+    # update of a model container (None if the file holds raw float32 weights)
+    data.seek(0)
+    magic = data.read(len(modelformat.MAGIC))
+    data.seek(0)
+
+    if not modelformat.is_container(magic):
+        return None
+
+    return modelformat.decode_update(data.read())
+
 
 class MLModel:
 
-    def __init__(self, size, state):
+    def __init__(self, size, state, dtype=None, chunk_size=None, layers=None):
 
+        # (weighted) number of accumulated devices
         self.devices = 0
 
+        # (weighted) number of accumulated updates relative to the base model (delta and sparse uploads)
+        self.deltas = 0
+
+        # accumulator precision (float64 avoids precision loss when summing many devices)
+        dtype = np.dtype(dtype or settings.AGGREGATION_DTYPE)
+
+        # read uploads in chunks aligned to the weights dtype, so memory is bounded by chunk_size
+        chunk_size = chunk_size or settings.AGGREGATION_CHUNK_SIZE
+        self.chunk_size = max(WEIGHTS_DTYPE.itemsize, chunk_size - chunk_size % WEIGHTS_DTYPE.itemsize)
+
         if state == "random":
-            self.weights = np.random.rand(size)
+            self.weights = np.random.rand(size).astype(dtype)
         elif state == "zeros":
-            self.weights = np.zeros(size)
+            self.weights = np.zeros(size, dtype=dtype)
         else:
             raise Exception("Unknown state:" + state)
 
-    def accumulate_model(self, file_path):
+        # layers of the model (see modelregistry), a single flat layer if unknown
+        self.layers = layers or [modelregistry.Layer('weights', (size,), size)]
+        if sum(layer.size for layer in self.layers) != size:
+            raise Exception("Layer sizes don't match the model size: %d" % size)
 
+    @classmethod
+    def from_spec(cls, spec, state="zeros", dtype=None):
+        return cls(spec.size, state, dtype, layers=spec.layers)
+
+    def accumulate_file(self, data, weight=1):
+
+        # compact model containers are decoded at once (they are small)
+        try:
+            update = decodefile(data)
+        except ValueError as ex:
+            print("Ignoring invalid model container: %s" % ex)
+            return False
+
+        if update is not None:
+            return self.accumulate_update(update, weight)
+
+        # check the length before touching the accumulator (avoid partial accumulation)
+        if data.size != len(self.weights) * WEIGHTS_DTYPE.itemsize:
+            print("Ignoring weights with incorrect length: %d" % (data.size // WEIGHTS_DTYPE.itemsize))
+            return False
+
+        # accumulate block-wise (local files are paged in from a memory map instead of being read)
+        mapped = mapfile(data)
+        if mapped is not None:
+            step = self.chunk_size // WEIGHTS_DTYPE.itemsize
+            blocks = (mapped[offset:offset + step] for offset in range(0, len(mapped), step))
+        else:
+            blocks = (np.frombuffer(chunk, dtype=WEIGHTS_DTYPE) for chunk in data.chunks(self.chunk_size))
+
+        offset = 0
+        for weights in blocks:
+            if weight == 1:
+                self.weights[offset:offset + len(weights)] += weights
+            else:
+                self.weights[offset:offset + len(weights)] += weights * weight
+            offset += len(weights)
+
+        self.devices += weight
+        return True
+
+    def accumulate_weights(self, weights, weight=1):
+        if weight == 1:
+            np.add(self.weights, weights, out=self.weights)
+        else:
+            self.weights += weights * weight
+        self.devices += weight
+
+    def accumulate_update(self, update, weight=1):
+
+        if update.size != len(self.weights) or (update.indices is None and len(update.values) != len(self.weights)):
+            print("Ignoring weights with incorrect length: %d" % update.size)
+            return False
+
+        # sparse updates are scattered into the accumulator (cost proportional to the non-zeros)
+        if update.kind == 'sparse':
+            if len(update.indices) > 0 and update.indices.max() >= len(self.weights):
+                print("Ignoring sparse update with out of range indices")
+                return False
+
+            np.add.at(self.weights, update.indices, update.values if weight == 1 else update.values * weight)
+            self.devices += weight
+
+        else:
+            self.accumulate_weights(update.values, weight)
+
+        if update.kind != 'full':
+            self.deltas += weight
+
+        return True
+
+    def resolve_deltas(self, base_path):
+
+        # updates relative to the base model were accumulated without it, so add it once per update
+        if self.deltas == 0:
+            return True
+
+        base = MLModel(len(self.weights), "zeros", dtype=self.weights.dtype)
+        if not base.read(base_path):
+            print("Base model is not available, ignoring the accumulated updates.")
+            return False
+
+        self.weights += base.weights * self.deltas
+        self.deltas = 0
+        return True
+
+    def read(self, file_path, dtype=WEIGHTS_DTYPE):
+
+        # replace the weights with the ones stored at file_path (False if missing or of different length)
+        dtype = np.dtype(dtype)
         try:
             with default_storage.open(file_path) as data:
-                weights = np.frombuffer(data.read(), dtype=np.float32)
-                if len(weights) == len(self.weights):
-                    self.weights += weights
-                    self.devices += 1
-                else:
-                    print("Ignoring weights with incorrect length: %d" % len(weights))
-        except (OSError, IOError) as ex:
-            print("Something went wrong while accumulating model at '%s'" % file_path)
+
+                # model containers are decoded (full float32 models only), raw files are mapped or read
+                update = decodefile(data) if dtype == WEIGHTS_DTYPE else None
+                weights = update.values if update is not None and update.kind == 'full' else None
+                if update is None and data.size % dtype.itemsize == 0:
+                    weights = mapfile(data, dtype)
+                    if weights is None:
+                        weights = np.frombuffer(data.read(), dtype=dtype)
+
+        except (OSError, IOError, ValueError) as ex:
+            print("Something went wrong while reading model at '%s'" % file_path)
             print(ex)
+            return False
+
+        if weights is None or len(weights) != len(self.weights):
+            print("Ignoring weights with incorrect length: %d" % (0 if weights is None else len(weights)))
+            return False
+
+        self.weights[:] = weights
+        return True
 
     def aggregate(self):
-        if self.devices > 1:
+        if self.devices > 0:
             self.weights /= self.devices
         self.devices = 0
+        self.deltas = 0
+
+    def write(self, filename, dtype=WEIGHTS_DTYPE, model_format='FLOAT32', compression='NONE'):
+
+        # returns the sha1 checksum of the written file
+
+        # compact model container (quantized per layer)
+        if not modelformat.is_raw(model_format, compression):
+            tensors = [layer.size for layer in self.layers]
+            content = modelformat.encode(self.weights, model_format, compression, tensors)
+            filereplace(filename, ContentFile(content))
+            return hashlib.sha1(content).hexdigest()
+
+        # local filesystem: write through a memory map into a new file (never in place, it may be hard-linked)
+        path = localpath(filename)
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(path)
+            mapped = np.memmap(path, dtype=dtype, mode='w+', shape=self.weights.shape)
+            mapped[:] = self.weights
+            mapped.flush()
+            checksum = hashlib.sha1(mapped).hexdigest()
+            del mapped
+            return checksum
 
-    def write(self, filename):
-        content = ContentFile(self.weights.astype('float32'))
-        default_storage.save(filename, content)
+        content = self.weights.astype(dtype).tobytes()
+        filereplace(filename, ContentFile(content))
+        return hashlib.sha1(content).hexdigest()
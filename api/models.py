@@ -5,12 +5,14 @@ from django.dispatch import receiver
 from django.db.models.signals import post_save, post_delete
 from django.db.models import JSONField
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.utils import timezone
+from django.conf import settings
 from api.libs.filemanagement import filecopy
+from api.libs.modelregistry import model_file
 from api import server_control as sc
 
 
-MODELS_PATH = 'models'
 PROJECTS_PATH = 'projects'
 
 
@@ -26,7 +28,7 @@ class Project(models.Model):
     MODEL_CHOICES = (
         # value, text
         ('CIFAR10_B20', 'CIFAR-10 - B20'),
-    )
+    ) + settings.EXTRA_MODELS
 
     DATASET_CHOICES = (
         # value, text
@@ -46,6 +48,30 @@ class Project(models.Model):
         ('JOINT_MODELS', 'Joint Models'),
     )
 
+    MODEL_FORMAT_CHOICES = (
+        # value, text
+        ('FLOAT32', 'Float32 (raw)'),
+        ('FLOAT16', 'Float16'),
+        ('INT8', 'Int8 (per-tensor quantization)'),
+    )
+
+    MODEL_COMPRESSION_CHOICES = (
+        # value, text
+        ('NONE', 'None'),
+        ('DEFLATE', 'Deflate'),
+        ('ZSTD', 'Zstandard'),
+    )
+
+    AGGREGATION_CHOICES = (
+        # value, text
+        ('FEDAVG', 'FedAvg'),
+        ('WEIGHTED_FEDAVG', 'FedAvg (weighted by samples)'),
+        ('TRIMMED_MEAN', 'Trimmed Mean'),
+        ('MEDIAN', 'Coordinate-wise Median'),
+        ('FEDADAM', 'FedAdam'),
+        ('FEDYOGI', 'FedYogi'),
+    )
+
     create_date = models.DateTimeField(auto_now_add=True)
     title = models.CharField(max_length=30, unique=True)
     description = models.TextField(null=True, blank=True)
@@ -53,6 +79,8 @@ class Project(models.Model):
     status = models.CharField(max_length=30, choices=STATUS_CHOICES, default=STATUS_CHOICES[0][0], help_text='Project State.')
 
     model = models.CharField(max_length=30, choices=MODEL_CHOICES, default=MODEL_CHOICES[0][0], help_text='Model type.')
+    model_format = models.CharField(max_length=30, choices=MODEL_FORMAT_CHOICES, default=MODEL_FORMAT_CHOICES[0][0], help_text='Encoding of the models exchanged with the devices.')
+    model_compression = models.CharField(max_length=30, choices=MODEL_COMPRESSION_CHOICES, default=MODEL_COMPRESSION_CHOICES[0][0], help_text='Compression of the models exchanged with the devices.')
     dataset = models.CharField(max_length=30, choices=DATASET_CHOICES, default=DATASET_CHOICES[0][0], help_text='Training dataset.')
     dataset_type = models.CharField(max_length=30, choices=DATASET_TYPE)
     training_mode = models.CharField(max_length=30, choices=TRAINING_MODE_TYPE)
@@ -71,9 +99,23 @@ class Project(models.Model):
 
     seed = models.PositiveIntegerField(default=42524235, null=True, blank=True, help_text='Seed to be used when training. Empty for random.')
 
+    # retention fields
+    status_retention_days = models.PositiveIntegerField(null=True, blank=True, help_text='Days the device pings of the devices of this project are kept before being rolled up and archived. Empty for the server default (STATUS_RETENTION_DAYS).')
+
+    # aggregation fields
+    aggregation_strategy = models.CharField(max_length=30, choices=AGGREGATION_CHOICES, default=AGGREGATION_CHOICES[0][0], help_text='Strategy for aggregating the device models of a round.')
+    trim_ratio = models.DecimalField(default=0.10, help_text='Ratio of largest and smallest values dropped per weight (Trimmed Mean only).', max_digits=3, decimal_places=2)
+    server_learning_rate = models.FloatField(default=0.1, help_text='Server learning rate (FedAdam and FedYogi only).')
+    server_beta1 = models.FloatField(default=0.9, help_text='First moment decay rate (FedAdam and FedYogi only).')
+    server_beta2 = models.FloatField(default=0.99, help_text='Second moment decay rate (FedAdam and FedYogi only).')
+    server_tau = models.FloatField(default=0.001, help_text='Degree of adaptivity (FedAdam and FedYogi only).')
+
     # read-only fields
     current_round = models.PositiveIntegerField(default=0)
 
+    # claimed by a scheduler check until this date (see scheduling.tick_project)
+    check_lease_date = models.DateTimeField(null=True, blank=True, editable=False, help_text='Date until which the project is being checked by the scheduler.')
+
     def __str__(self):
         return self.title
 
@@ -94,18 +136,17 @@ def save_project_hook(sender, instance, created, **kwargs):
         )
 
     # NOTE: It assumes that model type never changes!
-    # If we ever support more models this needs to be adapted
     if created:
         filecopy(
-            os.path.join(MODELS_PATH, instance.model + '.bin'),
+            model_file(instance.model),
             os.path.join(PROJECTS_PATH, str(instance.id), '0', 'model_weights.bin'))
 
 
 @receiver(post_delete, sender=Project)
 def delete_project_hook(sender, instance, using, **kwargs):
 
-    # delete all relevant files in S3
-    sc.delete_project(instance)
+    # delete all relevant files in S3 once the deletion is committed (off the request thread, it may take a while)
+    transaction.on_commit(lambda: sc.delete_project(instance, background=True))
 
 
 class Round(models.Model):
@@ -131,13 +172,36 @@ class Round(models.Model):
     number_of_epochs = models.PositiveIntegerField()
     seed = models.PositiveIntegerField()
 
+    # invalid rounds don't produce a model, so the next round references an earlier one (see server_control.copy_model)
+    model_round_number = models.PositiveIntegerField(null=True, blank=True, help_text='Round whose model is used by this round (if not its own).')
+    model_checksum = models.CharField(max_length=40, blank=True, default='', help_text='SHA-1 checksum of the model of the round (its ETag).')
+
+    # running sum of the device models uploaded during training (see server_control.fold_model)
+    partial_devices = JSONField(default=dict, blank=True, help_text='Checksum of each device model folded into the partial aggregate (by device id).')
+    partial_deltas = models.IntegerField(default=0, help_text='Number of updates relative to the model of the round (delta uploads) in the partial aggregate.')
+    partial_valid = models.BooleanField(default=True, help_text='Whether the partial aggregate can be used when the round completes.')
+    pending_devices = JSONField(default=dict, blank=True, help_text='Checksum of each device model uploaded but not folded into the partial aggregate yet (by device id).')
+
     # each project has multiple rounds
     project = models.ForeignKey(Project, related_name='rounds', blank=True, null=True, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['project', 'round_number'], name='unique_project_round'),
+        ]
+
     @property
     def model(self):
         return self.project.model
 
+    @property
+    def model_format(self):
+        return self.project.model_format
+
+    @property
+    def model_compression(self):
+        return self.project.model_compression
+
     @property
     def dataset(self):
         return self.project.dataset
@@ -213,6 +277,7 @@ class Device(models.Model):
     incremental = models.CharField(max_length=30, null=True, blank=True, help_text="Incremental (Android only).")
     os_version = models.CharField(max_length=10, null=True, blank=True, verbose_name="OS version", help_text="OS version.")
     security_patch = models.CharField(max_length=15, null=True, blank=True, help_text="Security Patch (Android only).")
+    details_hash = models.CharField(max_length=40, blank=True, default='', help_text="Checksum of the last reported device details (unchanged details are not saved again).")
 
     # dataset
     samples_index = models.PositiveIntegerField(default=0, help_text='Index of sample file to be downloaded.')
@@ -264,6 +329,18 @@ class RequestedTrainingRounds(models.Model):
     date_requested = models.DateTimeField(auto_now_add=True)
 
 
+class SchedulerEvent(models.Model):
+
+    # wakes up the scheduler for a project (see the scheduler command), deleted once handled
+
+    create_date = models.DateTimeField(auto_now_add=True)
+    project = models.ForeignKey(Project, related_name='scheduler_events', on_delete=models.CASCADE)
+    reason = models.CharField(max_length=30, help_text="What happened, like 'train-response'.")
+
+    def __str__(self):
+        return "%s: %s" % (self.project, self.reason)
+
+
 class DeviceTrainRequest(models.Model):
 
     create_date = models.DateTimeField(auto_now_add=True)
@@ -275,21 +352,207 @@ class DeviceTrainRequest(models.Model):
     round = models.OneToOneField(Round, related_name='device_train_request', on_delete=models.CASCADE)
 
 
+def device_status_fields(data):
+
+    # typed fields of the device_info of a status response (None if not reported)
+    battery_status = data.get('battery_status') or {}
+    active_network = (data.get('connectivity_status') or {}).get('active_network') or {}
+    usage_stats_details = data.get('usage_stats_details') or {}
+
+    power_plugged = battery_status.get('power_plugged')
+    battery_level = battery_status.get('level')
+    standby_bucket = usage_stats_details.get('app_standby_bucket')
+
+    return {
+        'power_plugged': power_plugged if isinstance(power_plugged, bool) else None,
+        'battery_level': float(battery_level) if isinstance(battery_level, (int, float)) else None,
+        'network_type': active_network.get('type_name'),
+        'standby_bucket': standby_bucket if isinstance(standby_bucket, int) else None,
+    }
+
+
 class DeviceStatusResponse(models.Model):
 
-    create_date = models.DateTimeField(auto_now_add=True)
+    create_date = models.DateTimeField(auto_now_add=True, db_index=True)
     data = JSONField(default=dict)
 
+    # typed copies of the most queried fields of data (see device_status_fields)
+    power_plugged = models.BooleanField(null=True, help_text='Whether the device was power plugged.')
+    battery_level = models.FloatField(null=True, help_text='Battery level (0 to 1).')
+    network_type = models.CharField(max_length=30, null=True, blank=True, help_text="Type of the active network, like 'WIFI' or 'MOBILE'.")
+    standby_bucket = models.IntegerField(null=True, help_text='App standby bucket (Android only).')
+
     # one device with many responses
     device = models.ForeignKey(Device, related_name='device_status_responses', on_delete=models.CASCADE)
 
     # only one response
     device_train_request = models.ForeignKey(DeviceTrainRequest, related_name='device_train_responses', blank=True, null=True, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['device', 'create_date']),
+        ]
+
     def __str__(self):
         return "%s: %s" % (self.device, self.create_date)
 
 
+class DeviceStatusRollup(models.Model):
+
+    # hourly summary of the device pings of a device, kept once the pings are archived (see api/retention.py)
+
+    device = models.ForeignKey(Device, related_name='device_status_rollups', on_delete=models.CASCADE)
+    hour = models.DateTimeField(help_text='Start of the hour.')
+
+    responses = models.PositiveIntegerField(default=0, help_text='Number of pings.')
+    plugged_responses = models.PositiveIntegerField(default=0, help_text='Number of pings while power plugged.')
+    min_battery_level = models.FloatField(null=True, blank=True, help_text='Lowest battery level (0 to 1).')
+    max_battery_level = models.FloatField(null=True, blank=True, help_text='Highest battery level (0 to 1).')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['device', 'hour'], name='unique_device_hour'),
+        ]
+
+    @property
+    def plugged_ratio(self):
+        return self.plugged_responses / self.responses if self.responses else 0.0
+
+    def __str__(self):
+        return "%s: %s" % (self.device, self.hour)
+
+
+class DeviceLatestStatus(models.Model):
+
+    # latest status reported by each device (upserted on every response), for selecting available devices
+    # without scanning the responses
+
+    device = models.OneToOneField(Device, related_name='latest_status', primary_key=True, on_delete=models.CASCADE)
+
+    last_seen = models.DateTimeField(db_index=True, help_text='Date of the latest response.')
+    power_plugged = models.BooleanField(null=True, help_text='Whether the device was power plugged.')
+    battery_level = models.FloatField(null=True, help_text='Battery level (0 to 1).')
+    network_type = models.CharField(max_length=30, null=True, blank=True, help_text="Type of the active network, like 'WIFI' or 'MOBILE'.")
+    standby_bucket = models.IntegerField(null=True, help_text='App standby bucket (Android only).')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['power_plugged', 'last_seen']),
+            models.Index(fields=['battery_level', 'last_seen']),
+        ]
+
+    def __str__(self):
+        return "%s: %s" % (self.device, self.last_seen)
+
+
+def record_latest_status(device, data):
+
+    # upsert the latest status of a device
+    fields = device_status_fields(data)
+    fields['last_seen'] = timezone.now()
+
+    if DeviceLatestStatus.objects.filter(device=device).update(**fields) == 0:
+        try:
+            with transaction.atomic():
+                DeviceLatestStatus.objects.create(device=device, **fields)
+
+        # created meanwhile (concurrent response of the same device)
+        except IntegrityError:
+            DeviceLatestStatus.objects.filter(device=device).update(**fields)
+
+
+class ModelCacheCounter(models.Model):
+
+    # hits and misses of the local model cache of all workers (see libs/modelcache.py), incremented atomically
+
+    name = models.CharField(max_length=30, primary_key=True, help_text="Counted event, 'hits' or 'misses'.")
+    count = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return "%s: %d" % (self.name, self.count)
+
+
+def add_model_cache_counts(counts):
+
+    # add to the counters (a single update each, so concurrent workers don't lose counts)
+    for name, count in counts.items():
+        if count and ModelCacheCounter.objects.filter(name=name).update(count=models.F('count') + count) == 0:
+            try:
+                with transaction.atomic():
+                    ModelCacheCounter.objects.create(name=name, count=count)
+
+            # created meanwhile (by another worker)
+            except IntegrityError:
+                ModelCacheCounter.objects.filter(name=name).update(count=models.F('count') + count)
+
+
 class NotificationSent(models.Model):
 
     create_date = models.DateTimeField(auto_now_add=True)
+
+
+class PushMessage(models.Model):
+
+    # outbox of push notifications, one message per batch of users (see api/push_outbox.py)
+
+    class Status(models.IntegerChoices):
+        PENDING = 1, ('pending')
+        SENDING = 2, ('sending')
+        SENT = 3, ('sent')
+        FAILED = 4, ('failed')
+
+    create_date = models.DateTimeField(auto_now_add=True)
+
+    notification = JSONField(default=dict, help_text='Notification sent to the provider (without the users).')
+    users = JSONField(default=list, help_text='Usernames the notification is sent to (at most PUSH_BATCH_SIZE).')
+
+    # train request pushed (if any)
+    train_request = models.ForeignKey(DeviceTrainRequest, related_name='push_messages', blank=True, null=True, on_delete=models.CASCADE)
+
+    status = models.IntegerField(choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveIntegerField(default=0, help_text='Number of sending attempts.')
+    next_attempt_date = models.DateTimeField(default=timezone.now, help_text='When the message is sent (again).')
+    sent_date = models.DateTimeField(null=True, blank=True)
+    response = JSONField(null=True, blank=True, help_text='Response of the provider (or error) of the last attempt.')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_date']),
+        ]
+
+    def __str__(self):
+        return "%d users: %s" % (len(self.users), self.get_status_display())
+
+
+class TrainRequestDelivery(models.Model):
+
+    # push delivery of a train request to a device, and its first acknowledgement (the device joining the round
+    # or responding), see device_control.repush_train_request
+
+    train_request = models.ForeignKey(DeviceTrainRequest, related_name='deliveries', on_delete=models.CASCADE)
+    device = models.ForeignKey(Device, related_name='train_request_deliveries', on_delete=models.CASCADE)
+
+    # last push message (with the response of the provider)
+    message = models.ForeignKey(PushMessage, related_name='deliveries', blank=True, null=True, on_delete=models.SET_NULL)
+
+    pushes = models.PositiveIntegerField(default=1, help_text='Number of times the train request was pushed to the device.')
+    last_push_date = models.DateTimeField(default=timezone.now, help_text='When the train request was last pushed (queued).')
+    sent_date = models.DateTimeField(null=True, blank=True, help_text='When the provider first accepted the push.')
+    ack_date = models.DateTimeField(null=True, blank=True, help_text='When the device first acknowledged the train request.')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['train_request', 'device'], name='unique_train_request_device'),
+        ]
+
+    def __str__(self):
+        return "%s: %s" % (self.device, self.train_request_id)
+
+
+def acknowledge_train_request(device, round):
+
+    # first acknowledgement of the train request of the round by the device
+    TrainRequestDelivery.objects.filter(
+        train_request__round=round,
+        device=device,
+        ack_date__isnull=True).update(ack_date=timezone.now())
@@ -0,0 +1,193 @@
+import threading
+
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from api.models import PushMessage
+from api.libs import pushwoosh_api as push
+
+
+# Push notifications are queued in an outbox (PushMessage, one message per PUSH_BATCH_SIZE users) and sent by a
+# background thread of the process, so callers (like the scheduler) return at once. Messages are sent
+# concurrently over pooled connections, and retried with exponential backoff on timeouts and provider errors.
+# Processes that exit early (like the tick command) close the outbox first.
+
+# messages being sent are retried after this many seconds (if their sender died meanwhile)
+LEASE_SECONDS = 300
+
+# messages claimed (and sent concurrently) at once
+DISPATCH_LIMIT = 100
+
+_wakeup = threading.Event()
+_thread = None
+_lock = threading.Lock()
+
+# held while sending, stopped once the process is about to exit (see close)
+_dispatch_lock = threading.Lock()
+_stopped = False
+
+
+def enqueue(notification, users, train_request=None):
+
+    # queue a notification, split into messages of at most PUSH_BATCH_SIZE users. Created one by one, as
+    # callers need their ids (not set by bulk_create on every database), and messages are few
+    messages = [
+        PushMessage.objects.create(notification=notification, users=users[i:i + settings.PUSH_BATCH_SIZE], train_request=train_request)
+        for i in range(0, len(users), settings.PUSH_BATCH_SIZE)]
+
+    # sent once committed (the caller may be in a transaction)
+    transaction.on_commit(start)
+
+    return messages
+
+
+def send_data(users, data, ttl_mins, verbose=False, train_request=None):
+
+    if len(users) == 0:
+        print("Error: Tried to push data to an empty list of users.")
+        return []
+
+    verbose and print("Queued push data for %d users." % len(users))
+    return enqueue(push.data_notification(data, ttl_mins), users, train_request)
+
+
+def send_notification(users, send_date, header, content, ttl_mins=1440, verbose=False):
+
+    if len(users) == 0:
+        print("Error: Tried to push data to an empty list of users.")
+        return []
+
+    verbose and print("Queued push notification for %d users." % len(users))
+    return enqueue(push.text_notification(send_date, header, content, ttl_mins), users)
+
+
+def __claim(limit):
+
+    # due messages (pending, or being sent by a sender that died), leased to this sender. A message is only
+    # claimed if no other sender claimed it meanwhile (its attempts and lease change when claimed)
+    now = timezone.now()
+    messages = PushMessage.objects.filter(
+        status__in=[PushMessage.Status.PENDING, PushMessage.Status.SENDING],
+        next_attempt_date__lte=now).order_by('next_attempt_date')[:limit]
+
+    claimed = []
+    for message in messages:
+        updated = PushMessage.objects.filter(
+            id=message.id,
+            attempts=message.attempts,
+            next_attempt_date=message.next_attempt_date).update(
+                status=PushMessage.Status.SENDING,
+                attempts=F('attempts') + 1,
+                next_attempt_date=now + timedelta(seconds=LEASE_SECONDS))
+        if updated:
+            claimed.append(message)
+
+    return claimed
+
+
+def __send(message, verbose=False):
+    try:
+        return push.create_message(message.notification, message.users, verbose), None
+
+    except push.PushError as ex:
+        return None, ex
+
+
+def dispatch(limit=DISPATCH_LIMIT, verbose=False):
+
+    # send the due messages, returns the number of messages attempted
+    messages = __claim(limit)
+    if not messages:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=settings.PUSH_WORKERS) as executor:
+        results = list(executor.map(lambda message: __send(message, verbose), messages))
+
+    now = timezone.now()
+    for message, (response, error) in zip(messages, results):
+        message.attempts += 1
+
+        if error is None:
+            message.status = PushMessage.Status.SENT
+            message.sent_date = now
+            message.response = response
+
+            # delivery of a train request (first accepted push of each device)
+            if message.train_request_id is not None:
+                message.deliveries.filter(sent_date__isnull=True).update(sent_date=now)
+
+        elif error.retryable and message.attempts < settings.PUSH_RETRIES:
+            message.status = PushMessage.Status.PENDING
+            message.next_attempt_date = now + timedelta(seconds=settings.PUSH_RETRY_BACKOFF * 2 ** (message.attempts - 1))
+            message.response = {'error': str(error)}
+
+        else:
+            print("Unable to send push message %d (%d users): %s" % (message.id, len(message.users), error))
+            message.status = PushMessage.Status.FAILED
+            message.response = {'error': str(error)}
+
+        message.save(update_fields=['status', 'attempts', 'next_attempt_date', 'sent_date', 'response'])
+
+    return len(messages)
+
+
+def __flush(verbose=False):
+    count = 0
+    while True:
+        dispatched = dispatch(verbose=verbose)
+        if dispatched == 0:
+            return count
+        count += dispatched
+
+
+def flush(verbose=False):
+
+    # send all due messages (messages waiting for a retry are left to the next flush or the background thread)
+    with _dispatch_lock:
+        return __flush(verbose)
+
+
+def close(verbose=False):
+
+    # stop the background thread (once done with the messages it is sending) and send the due messages,
+    # before the process exits
+    global _stopped
+    with _dispatch_lock:
+        _stopped = True
+        _wakeup.set()
+        return __flush(verbose)
+
+
+def start():
+
+    # start (or wake up) the background thread sending the messages of this process
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name='push-outbox', daemon=True)
+            _thread.start()
+
+    _wakeup.set()
+
+
+def _run():
+    while True:
+        _wakeup.clear()
+        try:
+            with _dispatch_lock:
+                if _stopped:
+                    return
+                __flush()
+        except Exception as ex:
+            print("Unable to send push messages: %s" % ex)
+
+        # don't keep a broken connection around
+        close_old_connections()
+
+        # until new messages are queued (or retries are due)
+        _wakeup.wait(settings.PUSH_RETRY_BACKOFF)
@@ -3,7 +3,7 @@ from datetime import datetime, timedelta, time
 from api.models import NotificationSent, User
 
 from django.utils import timezone
-from api.libs import pushwoosh_api as push
+from api import push_outbox as push
 
 
 REGISTRATION_TIME = 6  # in UTC
@@ -0,0 +1,131 @@
+import io
+import os
+import gzip
+import json
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from api.models import Project, DeviceStatusResponse, DeviceStatusRollup
+from api.libs.filemanagement import filereplace
+from api.libs import consts
+
+
+# Device pings are kept for STATUS_RETENTION_DAYS (or the retention of the project of the device). Older pings
+# are rolled up per device and hour (DeviceStatusRollup), archived into the storage as gzipped JSON lines and
+# deleted, in batches. Train responses are never deleted (rounds are evaluated with them).
+
+
+def __cutoff(days):
+
+    # whole hours only, so each hour is rolled up at once
+    return (timezone.now() - timedelta(days=days)).replace(minute=0, second=0, microsecond=0)
+
+
+def __retention_scopes():
+
+    # (pings, cutoff date) for the projects with their own retention, and for all other devices
+    pings = DeviceStatusResponse.objects.filter(device_train_request__isnull=True)
+    projects = Project.objects.filter(status_retention_days__isnull=False)
+
+    scopes = [(pings.filter(device__profile__project=project), __cutoff(project.status_retention_days)) for project in projects]
+    scopes.append((pings.exclude(device__profile__project__in=projects), __cutoff(settings.STATUS_RETENTION_DAYS)))
+
+    return scopes
+
+
+def __archive(batch):
+
+    # write the pings into a gzipped JSON lines file (one file per batch, named by its ids, so retrying a batch
+    # that was archived but not deleted replaces its file instead of adding another one)
+    buffer = io.BytesIO()
+    first = last = None
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as file:
+        for response in batch.order_by('id').values('id', 'create_date', 'device_id', 'data').iterator():
+            first = first or response
+            last = response
+            file.write((json.dumps(response, cls=DjangoJSONEncoder) + '\n').encode('utf-8'))
+
+    filename = '%d-%d.jsonl.gz' % (first['id'], last['id'])
+    path = os.path.join(consts.STATUS_ARCHIVE_PATH, first['create_date'].strftime('%Y/%m/%d'), filename)
+    return filereplace(path, ContentFile(buffer.getvalue()))
+
+
+def __merge(rollup, row):
+    rollup.responses += row['responses']
+    rollup.plugged_responses += row['plugged_responses']
+
+    levels = [level for level in (rollup.min_battery_level, row['min_battery_level']) if level is not None]
+    rollup.min_battery_level = min(levels) if levels else None
+
+    levels = [level for level in (rollup.max_battery_level, row['max_battery_level']) if level is not None]
+    rollup.max_battery_level = max(levels) if levels else None
+
+
+def __rollup(batch):
+
+    # add the pings into the hourly rollups of their devices
+    rows = batch.annotate(hour=TruncHour('create_date')).values('device_id', 'hour').annotate(
+        responses=Count('id'),
+        plugged_responses=Count('id', filter=Q(power_plugged=True)),
+        min_battery_level=Min('battery_level'),
+        max_battery_level=Max('battery_level')).order_by()
+
+    for row in rows:
+        rollup, _ = DeviceStatusRollup.objects.select_for_update().get_or_create(device_id=row['device_id'], hour=row['hour'])
+        __merge(rollup, row)
+        rollup.save()
+
+
+def __process_batch(pings, cutoff, batch_size, archive, verbose=False):
+
+    ids = list(pings.filter(create_date__lt=cutoff).order_by('id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return 0
+
+    batch = DeviceStatusResponse.objects.filter(id__in=ids)
+
+    # archive first (if it fails, nothing is deleted)
+    if archive:
+        path = __archive(batch)
+        verbose and print("Archived %d pings into '%s'." % (len(ids), path))
+
+    with transaction.atomic():
+        __rollup(batch)
+        batch.delete()
+
+    return len(ids)
+
+
+def apply(batch_size=None, max_batches=None, archive=None, verbose=False):
+
+    # roll up, archive and delete the expired pings, returns the number of deleted pings
+    batch_size = batch_size or settings.STATUS_RETENTION_BATCH_SIZE
+    archive = settings.STATUS_ARCHIVE if archive is None else archive
+
+    deleted = 0
+    batches = 0
+    for pings, cutoff in __retention_scopes():
+        while max_batches is None or batches < max_batches:
+            count = __process_batch(pings, cutoff, batch_size, archive, verbose)
+            if count == 0:
+                break
+
+            deleted += count
+            batches += 1
+
+    verbose and print("Deleted %d expired pings." % deleted)
+    return deleted
+
+
+def tick(verbose=False):
+
+    # a bounded amount of work per tick (the rest is left for the next ticks)
+    return apply(max_batches=settings.STATUS_RETENTION_TICK_BATCHES, verbose=verbose)
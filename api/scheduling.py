@@ -1,95 +1,71 @@
+from django.conf import settings
 from django.utils import timezone
+from django.db import transaction, connection, connections
 from django.db.models import Q
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import heapq
+import threading
+import time
 
-from api.models import Project, Round, DeviceTrainRequest, DeviceStatusResponse
+from api.models import Project, Round, DeviceStatusResponse, DeviceLatestStatus, SchedulerEvent
 from api import device_control as dc
 from api import server_control as sc
 
 PAST_DEVICE_STATUS_REPORTS_CONSIDERATION_MINS = 60
 
 
-def __keep_last_per_device(responses, verbose=False):
-
-    device_responses = {}
-
-    for response in responses:
-
-        # get username
-        username = response.device.profile.user.username
-
-        # if device for this user does not exist
-        if username not in device_responses.keys():
-            device_responses[username] = response
-
-        # OR exists but its older
-        elif response.create_date > device_responses[username].create_date:
-            device_responses[username] = response
-
-    # convert into a list and return
-    return list(device_responses.values())
-
-
-def __query_device_status_responses(project, verbose=False):
-
-    # get all devices registered to this project
-    registered_devices = [profile.device for profile in project.profiles.all()]
+def __query_available_devices(project, verbose=False):
 
     # Past X minutes
     from_date_filter = timezone.now() - timedelta(minutes=PAST_DEVICE_STATUS_REPORTS_CONSIDERATION_MINS)
 
-    # apply filters
-    responses = DeviceStatusResponse.objects.filter(
-        create_date__gt=from_date_filter,
-        device__in=registered_devices)
+    # latest status of the devices registered to this project
+    statuses = DeviceLatestStatus.objects.filter(
+        device__profile__project=project,
+        last_seen__gt=from_date_filter)
 
     # build query based on settings in Project
     if project.power_plugged_only:
 
         # power plugged only
-        responses = responses.filter(data__battery_status__power_plugged=True)
+        statuses = statuses.filter(power_plugged=True)
 
     else:
 
         # power plugged OR > battery_level_threshold
         battery_level_threshold = float(project.battery_level_threshold)
-        responses = responses.filter(Q(data__battery_status__power_plugged=True) | Q(data__battery_status__level__gte=battery_level_threshold))
+        statuses = statuses.filter(Q(power_plugged=True) | Q(battery_level__gte=battery_level_threshold))
 
-    # only keep the last response per device
-    responses = __keep_last_per_device(responses, verbose)
-
-    return responses
+    # devices (with the users needed for push notifications)
+    return [status.device for status in statuses.select_related('device__profile__user')]
 
 
 def __is_project_complete(project, verbose=False):
 
     completed_rounds = Round.objects.filter(
         project=project,
-        status=Round.Status.COMPLETE)
+        status=Round.Status.COMPLETE).count()
 
-    if len(completed_rounds) >= project.number_of_rounds:
-        verbose and print("Project is complete (reached %d sucesfully completed rounds)" % len(completed_rounds))
+    if completed_rounds >= project.number_of_rounds:
+        verbose and print("Project is complete (reached %d sucesfully completed rounds)" % completed_rounds)
         return True
     else:
         return False
 
 
-def __check_for_round_completion(round, verbose=False):
+def __check_for_round_completion(round, all_devices, verbose=False):
 
     # get project
     project = round.project
 
     # check if devices are available
-    if project.profiles.count() == 0:
+    if all_devices == 0:
         verbose and print("No devices are attached to this project.")
         return
 
     # compute responses and ratio
-    try:
-        device_train_responses = round.device_train_request.device_train_responses.count()
-    except DeviceTrainRequest.DoesNotExist:
-        device_train_responses = 0
-    all_devices = project.profiles.count()
+    device_train_responses = DeviceStatusResponse.objects.filter(device_train_request__round=round).count()
     trained_ratio = device_train_responses / all_devices
 
     # check if time has passed (OR all devices reported a model)
@@ -100,86 +76,104 @@ def __check_for_round_completion(round, verbose=False):
 
             verbose and print("Reported models are enough (Ratio is %.2f). Round '%d' is complete." % (trained_ratio, round.round_number))
 
-            # set round status to complete
-            round.status = Round.Status.COMPLETE
-            round.stop_training_date = timezone.now()
-            round.save()
+            # set round status to complete (locked, so no more uploads are folded into it)
+            round = __stop_round(round, Round.Status.COMPLETE)
 
             # create next round
             next_round = __create_next_round(project, verbose)
 
-            # aggregate model of last round into the next round
-            sc.aggregate_model(round, next_round)
+            # aggregate model of last round into the next round (outside of any transaction, the round is
+            # already committed as complete, so uploads aren't blocked while aggregating)
+            try:
+                sc.aggregate_model(round, next_round, verbose)
+            except Exception as ex:
+                print("Unable to aggregate round '%d', keeping its model: %s" % (round.round_number, ex))
+                sc.copy_model(round, next_round)
 
             # check if it is time to set project as complete
             if __is_project_complete(project, verbose):
-                # set project status to complete
+                # set project status to complete (only it, the rest of the project may have been edited meanwhile)
                 project.status = Project.STATUS_CHOICES[2][0]
-                project.save()
+                project.save(update_fields=['status'])
 
             else:
                 # atempt training in new round
-                __attempt_device_training(next_round, verbose)
+                __attempt_device_training(next_round, all_devices, verbose)
 
         else:
             verbose and print("Time has pass. Round '%d' is invalid." % round.round_number)
-            __invalidate_round(round, verbose)
+            __invalidate_round(round, all_devices, verbose)
 
     else:
         remaining_mins = (round.start_training_date + timedelta(minutes=project.max_training_time) - timezone.now()).seconds / 60
         verbose and print("Waiting for %d more minutes. Current Ratio is %.2f (%d out of %d)." % (int(remaining_mins), trained_ratio, device_train_responses, all_devices))
 
+        # remind the devices that didn't get the train request
+        dc.repush_train_request(round, verbose)
+
 
-def __invalidate_round(round, verbose=False):
+def __stop_round(round, status):
 
-    round.status = Round.Status.INVALID
-    round.stop_training_date = timezone.now()
-    round.save()
+    with transaction.atomic():
+        round = Round.objects.select_for_update().get(pk=round.pk)
+        round.status = status
+        round.stop_training_date = timezone.now()
+        round.save()
+
+    return round
+
+
+def __invalidate_round(round, all_devices, verbose=False):
+
+    project = round.project
+    round = __stop_round(round, Round.Status.INVALID)
 
-    next_round = __create_next_round(round.project, verbose)
+    next_round = __create_next_round(project, verbose)
 
     # just copy the model
     sc.copy_model(round, next_round)
 
     # atempt training in new round
-    __attempt_device_training(next_round, verbose)
+    __attempt_device_training(next_round, all_devices, verbose)
 
 
 def __create_next_round(project, verbose=False):
 
-    next_round_number = project.current_round + 1
+    # atomic, with the project locked (concurrent ticks can't create the same round twice)
+    with transaction.atomic():
+        next_round_number = Project.objects.select_for_update().get(pk=project.pk).current_round + 1
 
-    verbose and print("Creating next round: %d" % (next_round_number))
+        verbose and print("Creating next round: %d" % (next_round_number))
 
-    # increase counter
-    project.current_round = next_round_number
-    project.save()
+        # increase counter (only it, the rest of the project may have been edited meanwhile)
+        Project.objects.filter(pk=project.pk).update(current_round=next_round_number)
+        project.current_round = next_round_number
 
-    round = Round.objects.create(
-        round_number=next_round_number,
-        number_of_samples=project.number_of_samples,
-        number_of_epochs=project.number_of_epochs,
-        seed=project.seed,
-        project=project
-    )
+        round = Round.objects.create(
+            round_number=next_round_number,
+            number_of_samples=project.number_of_samples,
+            number_of_epochs=project.number_of_epochs,
+            seed=project.seed,
+            project=project
+        )
 
     return round
 
 
-def __attempt_device_training(round, verbose=False):
+def __attempt_device_training(round, all_devices, verbose=False):
 
     # get project
     project = round.project
 
-    if project.profiles.count() == 0:
+    if all_devices == 0:
         verbose and print("Attempted to train but no devices are attached to this project.")
         return
 
-    # query responses based on the configuration on Project
-    queried_responses = __query_device_status_responses(project, verbose)
-    responses_ratio = len(queried_responses) / project.profiles.count()
+    # query available devices based on the configuration on Project
+    devices = __query_available_devices(project, verbose)
+    responses_ratio = len(devices) / all_devices
 
-    verbose and print("Ratio is %.2f (%d/%d)" % (responses_ratio, len(queried_responses), project.profiles.count()))
+    verbose and print("Ratio is %.2f (%d/%d)" % (responses_ratio, len(devices), all_devices))
 
     # if ratio > threshold
     if responses_ratio >= float(project.responses_ratio_threshold):
@@ -187,8 +181,7 @@ def __attempt_device_training(round, verbose=False):
         verbose and print("Sending train request:")
 
         # request device training
-        devices = [response.device for response in queried_responses]
-        dc.send_train_request(project, devices, verbose)
+        dc.send_train_request(project, devices, verbose, round=round)
 
         # log these devices and set into training status
         round.requested_training_devices.set(devices)
@@ -200,30 +193,75 @@ def __attempt_device_training(round, verbose=False):
         verbose and print("Attempted to train but failed to reach the threshold.")
 
 
-def tick(verbose=False):
+def __claim_project(project_id):
 
-    # get all active (In Progress) projects
-    projects = Project.objects.filter(status=Project.STATUS_CHOICES[1][0])
+    # claim a project for a check, for SCHEDULER_LEASE seconds (a single conditional update, so the project
+    # row is only locked while claiming it), renewed while the check runs (see __renew_project). Returns the
+    # project, None if claimed by another check
+    now = timezone.now()
+    claimed = Project.objects.filter(
+        Q(check_lease_date__isnull=True) | Q(check_lease_date__lt=now),
+        id=project_id,
+        status=Project.STATUS_CHOICES[1][0]).update(check_lease_date=now + timedelta(seconds=settings.SCHEDULER_LEASE))
 
-    verbose and print("Found %d available projects." % len(projects))
+    return Project.objects.get(id=project_id) if claimed else None
 
-    # ping / attempt to train devices in each active project
-    for project in projects:
 
+def __renew_project(project, done):
+
+    # heartbeat of a check (until 'done' is set), so that a check is only considered dead once it stops
+    # renewing its claim, however long it takes (e.g. aggregating the models)
+    try:
+        while not done.wait(settings.SCHEDULER_LEASE / 3):
+            lease_date = timezone.now() + timedelta(seconds=settings.SCHEDULER_LEASE)
+            if not Project.objects.filter(pk=project.pk, check_lease_date=project.check_lease_date).update(check_lease_date=lease_date):
+                print("Project '%d' was claimed by another check meanwhile." % project.pk)
+                return
+            project.check_lease_date = lease_date
+
+    # connections are per thread
+    finally:
+        connections.close_all()
+
+
+def __release_project(project):
+    Project.objects.filter(pk=project.pk, check_lease_date=project.check_lease_date).update(check_lease_date=None)
+
+
+def tick_project(project_id, verbose=False):
+
+    # check a project, claimed until done (overlapping ticks skip it). Returns whether it was checked. Each step
+    # commits on its own (e.g. the round is complete before its models are aggregated)
+    project = __claim_project(project_id)
+    if project is None:
+        verbose and print("Project '%d' is being checked by another tick (or not in progress)." % project_id)
+        return False
+
+    done = threading.Event()
+    heartbeat = threading.Thread(target=__renew_project, args=(project, done), name="lease:%d" % project.id, daemon=True)
+    heartbeat.start()
+
+    try:
         verbose and print("Project '%d. %s':" % (project.id, project.title))
 
         # get last created round of that project
         last_round = project.rounds.last()
 
+        # registered devices (counted once per check)
+        all_devices = project.profiles.count()
+
         # switch on status
         status = last_round.status
         if status == Round.Status.WAIT:
             verbose and print("Round status 'Wait': Evaluating device statuses.")
-            __attempt_device_training(last_round, verbose)
+            __attempt_device_training(last_round, all_devices, verbose)
 
         elif status == Round.Status.TRAINING:
             verbose and print("Round status 'Training': Checking for round completion.")
-            __check_for_round_completion(last_round, verbose)
+
+            # fold the models uploaded since the last check into the running sum of the round
+            sc.fold_uploads(last_round, verbose)
+            __check_for_round_completion(last_round, all_devices, verbose)
 
         elif status == Round.Status.COMPLETE:
             verbose and print("Round status 'Complete'.")
@@ -235,4 +273,175 @@ def tick(verbose=False):
 
         else:
             print("Unknown Round.status '%d':" % status)
-            return
+
+    finally:
+        done.set()
+        heartbeat.join()
+        __release_project(project)
+
+    return True
+
+
+def __check_project(project_id, verbose=False):
+
+    # check a project, returns the date of its next check
+    try:
+        if not tick_project(project_id, verbose):
+            return timezone.now() + timedelta(seconds=settings.SCHEDULER_AVAILABILITY_INTERVAL)
+
+        return next_check_date(Project.objects.get(id=project_id))
+
+    except Project.DoesNotExist:
+        return None
+
+    except Exception as ex:
+        print("Unable to check project '%d': %s" % (project_id, ex))
+        return timezone.now() + timedelta(seconds=settings.SCHEDULER_AVAILABILITY_INTERVAL)
+
+
+def check_project(project_id, verbose=False):
+
+    # check a project in a worker thread (see check_workers), returns the date of its next check
+    try:
+        return __check_project(project_id, verbose)
+
+    # connections are per thread
+    finally:
+        connections.close_all()
+
+
+def check_workers():
+
+    # projects checked concurrently. Databases without row locks (SQLite) check them one by one
+    if not connection.features.has_select_for_update:
+        return 1
+
+    return max(1, settings.SCHEDULER_WORKERS)
+
+
+def check_projects(project_ids, verbose=False):
+
+    # check projects concurrently (a slow aggregation doesn't delay the other projects), returns the
+    # date of the next check of each project
+    if check_workers() <= 1:
+        return dict((project_id, __check_project(project_id, verbose)) for project_id in project_ids)
+
+    with ThreadPoolExecutor(max_workers=check_workers()) as executor:
+        dates = executor.map(lambda project_id: check_project(project_id, verbose), project_ids)
+        return dict(zip(project_ids, dates))
+
+
+def next_check_date(project):
+
+    # when the project needs to be checked again (None if only events matter), see the scheduler command
+    if project.status != Project.STATUS_CHOICES[1][0]:
+        return None
+
+    last_round = project.rounds.last()
+
+    # availability of the devices is checked periodically
+    if last_round.status == Round.Status.WAIT:
+        return timezone.now() + timedelta(seconds=settings.SCHEDULER_AVAILABILITY_INTERVAL)
+
+    # the round times out (it completes earlier if all devices respond, see SchedulerEvent), meanwhile devices
+    # that didn't acknowledge the train request are pushed again
+    if last_round.status == Round.Status.TRAINING:
+        return min(
+            last_round.start_training_date + timedelta(minutes=project.max_training_time),
+            timezone.now() + timedelta(seconds=settings.PUSH_ACK_TIMEOUT))
+
+    return None
+
+
+class Daemon:
+
+    # state of the scheduler command, that checks each project at its next deadline (see next_check_date) or
+    # as soon as one of its devices responds (see SchedulerEvent). Checks run in worker threads, so that
+    # polling never blocks on them
+
+    def __init__(self, poll_interval, executor=None):
+        self.poll_interval = poll_interval
+        self.executor = executor or ThreadPoolExecutor(max_workers=check_workers())
+
+        # (date, project id) of the next check of each project, the latest date per project in 'deadlines'
+        self.queue = []
+        self.deadlines = {}
+
+        # projects to check now (all projects in progress on start), and checks in flight (project id of each future)
+        self.due = set()
+        self.running = {}
+        self.next_rescan = timezone.now()
+
+    def poll(self, verbose=False):
+
+        # start the checks that are due, returns the seconds until the next poll
+        now = timezone.now()
+
+        # projects in progress without a deadline (started meanwhile, or missed)
+        if now >= self.next_rescan:
+            in_progress = Project.objects.filter(status=Project.STATUS_CHOICES[1][0]).values_list('id', flat=True)
+            self.due.update(project_id for project_id in in_progress if project_id not in self.deadlines)
+            self.next_rescan = now + timedelta(seconds=settings.SCHEDULER_AVAILABILITY_INTERVAL)
+
+        # projects with events
+        self.due.update(self._consume_events())
+
+        # projects whose deadline passed
+        while self.queue and self.queue[0][0] <= now:
+            date, project_id = heapq.heappop(self.queue)
+            if self.deadlines.get(project_id) == date:
+                del self.deadlines[project_id]
+                self.due.add(project_id)
+
+        # schedule the next check of the projects checked meanwhile
+        done, _ = wait(list(self.running), timeout=0)
+        for future in done:
+            self._schedule(self.running.pop(future), future.result())
+
+        # check them, unless being checked (checked again once done, e.g. a device responded meanwhile)
+        in_flight = set(self.running.values())
+        for project_id in self.due - in_flight:
+            self.running[self.executor.submit(check_project, project_id, verbose)] = project_id
+        self.due &= in_flight
+
+        # until the next poll (or an earlier deadline)
+        timeout = self.poll_interval
+        if self.queue:
+            timeout = min(timeout, max(0, (self.queue[0][0] - timezone.now()).total_seconds()))
+        return timeout
+
+    def wait(self, timeout):
+
+        # sleep until the next poll, or until a check is done
+        if self.running:
+            wait(list(self.running), timeout=timeout, return_when=FIRST_COMPLETED)
+        else:
+            time.sleep(timeout)
+
+    def _schedule(self, project_id, date):
+        if date is not None:
+            self.deadlines[project_id] = date
+            heapq.heappush(self.queue, (date, project_id))
+        else:
+            self.deadlines.pop(project_id, None)
+
+    def _consume_events(self):
+        events = list(SchedulerEvent.objects.order_by('id').values_list('id', 'project_id'))
+        if events:
+            SchedulerEvent.objects.filter(id__lte=events[-1][0]).delete()
+
+        return set(project_id for _, project_id in events)
+
+
+def tick(verbose=False):
+
+    # events are not needed, all projects are checked
+    SchedulerEvent.objects.filter(create_date__lte=timezone.now()).delete()
+
+    # get all active (In Progress) projects
+    project_ids = list(Project.objects.filter(status=Project.STATUS_CHOICES[1][0]).values_list('id', flat=True))
+
+    verbose and print("Found %d available projects." % len(project_ids))
+
+    # ping / attempt to train devices in each active project
+    check_projects(project_ids, verbose)
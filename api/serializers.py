@@ -12,6 +12,8 @@ class ProjectSerializer(serializers.ModelSerializer):
 class RoundSerializer(serializers.ModelSerializer):
 
     model = serializers.ReadOnlyField()
+    model_format = serializers.ReadOnlyField()
+    model_compression = serializers.ReadOnlyField()
     dataset = serializers.ReadOnlyField()
     dataset_type = serializers.ReadOnlyField()
     training_mode = serializers.ReadOnlyField()
@@ -19,7 +21,7 @@ class RoundSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Round
-        fields = '__all__'
+        exclude = ['partial_devices', 'partial_deltas', 'partial_valid', 'pending_devices']
 
 
 class DeviceSerializer(serializers.ModelSerializer):
@@ -1,41 +1,57 @@
 import os
 
+from django.db import transaction
 from django.core.files.storage import default_storage
 
 from api.mlmodel import MLModel
+from api.mlaggregation import get_aggregator
 from api.mlreport import MLReport
 # from api.produce_plots import plot
-from api.libs.filemanagement import filecopy, delfolder
-from api.libs import consts
+from api.libs.filemanagement import filecopy, filereplace, filechecksum, fileversion, delfolder
+from api.libs import consts, modelregistry, urlcache
 
 import numpy as np
 
 
-def aggregate_model(round, into_round):
+def aggregate_model(round, into_round, verbose=False):
 
     # get project
     project = round.project
 
-    # init model with zeros (to append weights during aggregation)
-    model = MLModel(consts.MODEL_SIZE, "zeros")
-
-    # round level
-    round_path = os.path.join(consts.PROJECTS_PATH, str(project.id), str(round.round_number))
+    # aggregation strategy of the project
+    aggregator = get_aggregator(project)
 
     # get all devices that reported data (weights)
-    reported_devices = [response.device for response in round.device_train_request.device_train_responses.all()]
-    for device in reported_devices:
+    reported_devices = list(round.device_train_request.device_train_responses.values_list('device_id', flat=True).distinct())
 
-        # accumulate
-        file_path = os.path.join(round_path, str(device.id), consts.MODEL_WEIGHTS_FILENAME)
-        model.accumulate_model(file_path)
+    # model of the round (base of delta uploads and of server-side steps)
+    base_path = model_path(round)
 
-    # aggregate weights
-    model.aggregate()
+    # if the running sum of the round covers exactly these devices, just average it (once the last uploads
+    # are folded)
+    model = None
+    if aggregator.incremental:
+        round = fold_uploads(round, verbose)
+        model = __read_partial_model(round, reported_devices, base_path, verbose)
+
+    # otherwise, aggregate the device models
+    if model is None:
+        model = aggregator.aggregate(round, reported_devices, base_path, verbose)
+
+    # device updates can't be applied (e.g. base model of delta uploads is missing), keep the model of the round
+    if model is None:
+        print("Unable to aggregate the models of round '%d', keeping its model." % round.round_number)
+        copy_model(round, into_round)
+        return
+
+    # server-side step (if any)
+    model = aggregator.update(model, base_path, verbose)
 
     # write model into round folder
     file_path = os.path.join(consts.PROJECTS_PATH, str(project.id), str(into_round.round_number), consts.MODEL_WEIGHTS_FILENAME)
-    model.write(file_path)
+    into_round.model_checksum = model.write(file_path, model_format=project.model_format, compression=project.model_compression)
+    into_round.save(update_fields=['model_checksum'])
+    urlcache.forget_model(project.id, into_round.round_number)
 
     # TODO: Enable once server-based eval is implemented
     # # compute required list of result filenames (from number of apps)
@@ -50,23 +66,228 @@ def aggregate_model(round, into_round):
     # plot(path, result_filenames_list, project.title, consts.RESULTS_FIGURE_FILENAME)
 
 
-def copy_model(round, into_round):
+def fold_model(round, device_id, data=None, staged_path=None):
 
-    # get project
-    project = round.project
+    # save a device model upload (a file, e.g. streamed to disk while uploading) and queue it to be folded
+    # into the round's partial aggregate (running sum), so that completing the round does not need to read
+    # all device models again. Uploads already in the storage (staged_path, see uploads.upload_url) are
+    # moved server-side, without being read. Queued uploads are folded by the scheduler (see fold_uploads),
+    # so uploads never wait for each other, nor read or write the running sum.
+
+    # round level
+    file_path = __device_model_path(round, device_id)
+    previous_path = file_path + consts.PREVIOUS_SUFFIX
+    device_key = str(device_id)
+
+    # only needed by strategies that can use the running sum
+    incremental = get_aggregator(round.project).incremental
+
+    # keep the folded model of this device (if any), to replace its contribution. Unless it is kept already
+    # (a later upload of the device replaces an upload that is still queued)
+    if incremental:
+        partial_devices = type(round).objects.filter(pk=round.pk).values_list('partial_devices', flat=True).first() or {}
+        if device_key in partial_devices and not default_storage.exists(previous_path):
+            try:
+                if fileversion(file_path) == partial_devices[device_key]:
+                    filecopy(file_path, previous_path)
+            except (OSError, IOError):
+                pass
+
+    # save file
+    if staged_path is None:
+        filereplace(file_path, data)
+    else:
+        filecopy(staged_path, file_path)
+        default_storage.delete(staged_path)
+
+    if not incremental:
+        return
+
+    checksum = fileversion(file_path)
+
+    # the round is only locked to queue the upload
+    with transaction.atomic():
+        round = type(round).objects.select_for_update().get(pk=round.pk)
+
+        # too late (round is complete) or nothing to do (partial aggregate won't be used)
+        if round.status != type(round).Status.TRAINING or not round.partial_valid:
+            return
+
+        round.pending_devices[device_key] = checksum
+        round.save(update_fields=['pending_devices'])
+
+
+def __device_model_path(round, device_id):
+    return os.path.join(consts.PROJECTS_PATH, str(round.project_id), str(round.round_number), str(device_id), consts.MODEL_WEIGHTS_FILENAME)
+
+
+def __unfold(model, previous_path):
+
+    # subtract the contribution of the (folded) model a device uploaded before (kept by fold_model)
+    try:
+        with default_storage.open(previous_path) as previous:
+            return model.accumulate_file(previous, -1)
+
+    except (OSError, IOError):
+        return False
+
+
+def fold_uploads(round, verbose=False):
+
+    # fold the queued uploads of a round into its running sum, at once (read and written once per call). Run
+    # by the scheduler, that checks a project at a time. Returns the (refreshed) round
+    round = type(round).objects.get(pk=round.pk)
+    pending = dict(round.pending_devices)
+    if not pending:
+        return round
+
+    # round level
+    partial_path = os.path.join(consts.PROJECTS_PATH, str(round.project_id), str(round.round_number), consts.PARTIAL_WEIGHTS_FILENAME)
+
+    model = MLModel.from_spec(modelregistry.get_spec(round.project.model))
+    partial_devices = dict(round.partial_devices)
+    valid = round.partial_valid
+
+    # restore the running sum (delta and sparse updates are folded without the base model, which
+    # is added once per update when the round completes)
+    model.deltas = round.partial_deltas
+    if valid and partial_devices and not model.read(partial_path, dtype=model.weights.dtype):
+        valid = False
+
+    folded = {}
+    for device_key, checksum in pending.items():
+        if not valid:
+            break
+
+        folded_checksum = partial_devices.get(device_key)
+        file_path = __device_model_path(round, device_key)
+        try:
+            # uploaded again meanwhile (folded by the next call)
+            if fileversion(file_path) != checksum:
+                continue
+
+            folded[device_key] = checksum
 
-    original_model = os.path.join(consts.PROJECTS_PATH, str(project.id), str(round.round_number), consts.MODEL_WEIGHTS_FILENAME)
-    new_model = os.path.join(consts.PROJECTS_PATH, str(project.id), str(into_round.round_number), consts.MODEL_WEIGHTS_FILENAME)
-    filecopy(original_model, new_model)
+            # same model uploaded again
+            if folded_checksum == checksum:
+                continue
 
+            # replace the previous contribution of the device
+            if folded_checksum is not None:
+                if not __unfold(model, file_path + consts.PREVIOUS_SUFFIX):
+                    valid = False
+                    break
+                del partial_devices[device_key]
 
-def delete_project(project):
+            with default_storage.open(file_path) as data:
+
+                # invalid models are not folded (the round is then aggregated from the device models)
+                if model.accumulate_file(data):
+                    partial_devices[device_key] = checksum
+
+        except (OSError, IOError) as ex:
+            print("Unable to fold model at '%s': %s" % (file_path, ex))
+            valid = False
+
+    if valid and folded:
+        model.write(partial_path, dtype=model.weights.dtype)
+
+    # the round is only locked to update the bookkeeping (uploads may have been queued meanwhile)
+    with transaction.atomic():
+        round = type(round).objects.select_for_update().get(pk=round.pk)
+
+        for device_key, checksum in folded.items():
+            if round.pending_devices.get(device_key) == checksum:
+                del round.pending_devices[device_key]
+
+        if valid:
+            round.partial_devices = partial_devices
+            round.partial_deltas = model.deltas
+        else:
+            round.partial_valid = False
+            round.pending_devices = {}
+
+        round.save(update_fields=['pending_devices', 'partial_devices', 'partial_deltas', 'partial_valid'])
+
+    # previous models are not needed anymore (unless the device uploaded again meanwhile)
+    for device_key in pending:
+        if device_key not in round.pending_devices:
+            default_storage.delete(__device_model_path(round, device_key) + consts.PREVIOUS_SUFFIX)
+
+    verbose and print("Folded %d uploaded models into the partial aggregate of round '%d'." % (len(folded), round.round_number))
+    return round
+
+
+def __read_partial_model(round, reported_devices, base_path, verbose=False):
+
+    # round level
+    partial_path = os.path.join(consts.PROJECTS_PATH, str(round.project_id), str(round.round_number), consts.PARTIAL_WEIGHTS_FILENAME)
+
+    if not round.partial_valid or not round.partial_devices:
+        return None
+
+    folded_devices = set(int(device_id) for device_id in round.partial_devices.keys())
+    if folded_devices != set(reported_devices):
+        verbose and print("Partial aggregate covers %d devices but %d reported. Aggregating from device models." % (len(folded_devices), len(set(reported_devices))))
+        return None
+
+    model = MLModel.from_spec(modelregistry.get_spec(round.project.model))
+    if not model.read(partial_path, dtype=model.weights.dtype):
+        return None
+
+    # average the running sum
+    model.devices = len(folded_devices)
+    model.deltas = round.partial_deltas
+    if not model.resolve_deltas(base_path):
+        return None
+    model.aggregate()
+
+    verbose and print("Aggregated partial model of %d devices." % len(folded_devices))
+    return model
+
+
+def model_path(round):
+
+    # model of a round (stored in its own folder, unless it references the model of an earlier round)
+    round_number = round.round_number if round.model_round_number is None else round.model_round_number
+    return os.path.join(consts.PROJECTS_PATH, str(round.project_id), str(round_number), consts.MODEL_WEIGHTS_FILENAME)
+
+
+def model_checksum(round):
+
+    # checksum of the model of a round (computed from the file, once, if it wasn't recorded when written)
+    if not round.model_checksum:
+        try:
+            with default_storage.open(model_path(round)) as data:
+                round.model_checksum = filechecksum(data)
+
+        except (OSError, IOError):
+            return None
+
+        round.save(update_fields=['model_checksum'])
+
+    return round.model_checksum
+
+
+def copy_model(round, into_round):
+
+    # reference the model of the round instead of copying it
+    into_round.model_round_number = round.round_number if round.model_round_number is None else round.model_round_number
+    into_round.model_checksum = round.model_checksum
+    into_round.save(update_fields=['model_round_number', 'model_checksum'])
+    urlcache.forget_model(into_round.project_id, into_round.round_number)
+
+
+def delete_project(project, background=False):
 
     # project level
     path = os.path.join(consts.PROJECTS_PATH, str(project.id))
 
     # delete project folder
-    delfolder(path)
+    delfolder(path, background, verbose=True)
+
+    # forget the models of all rounds (rounds are numbered up to current_round)
+    urlcache.forget_models(project.id, range(project.current_round + 1))
 
 
 def reset_project(project):
@@ -78,8 +299,10 @@ def reset_project(project):
 
     # Copy the appropriate model into the project_path
     filecopy(
-        os.path.join(consts.MODELS_PATH, project.model + '.bin'),
+        modelregistry.model_file(project.model),
         os.path.join(path, '0', 'model_weights.bin'))
+    project.rounds.filter(round_number=0).update(model_checksum='')
+    urlcache.forget_model(project.id, 0)
 
     # reset counters
     project.current_round = 0
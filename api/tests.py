@@ -1,3 +1,938 @@
-from django.test import TestCase
+import os
+import gzip
+import hashlib
+import json
+import shutil
+import tempfile
+import time
 
-# Create your tests here.
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+import numpy as np
+
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, DatabaseError
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api.models import Project, Round, Device, DeviceTrainRequest, DeviceStatusResponse, DeviceStatusRollup, DeviceLatestStatus, JoinedRounds, PushMessage, TrainRequestDelivery, SchedulerEvent
+from api.libs.fakepushwoosh import FakePushwoosh
+from api.libs.filemanagement import filereplace
+from api.libs import consts, modelcache, modelformat, modelregistry, uploads, urlcache
+from api.mlaggregation import get_aggregator
+from api.ingestion import BulkBuffer
+from api import scheduling
+from api import views
+from api import async_views
+from api import push_outbox
+from api import retention
+from api import server_control as sc
+
+
+# queries of a scheduler check of one project (not counting aggregation)
+MAX_TICK_QUERIES = 20
+
+# size of the (flat) model used by the storage tests
+MODEL_SIZE = 8
+
+
+def create_project(title, devices=0):
+
+    # project in progress (its first round is created), joined by devices available for training
+    project = Project.objects.create(title=title, dataset_type='IID', training_mode='BASELINE', status='In Progress')
+
+    for i in range(devices):
+        user = User.objects.create_user(username='%s_%d' % (title, i))
+        user.profile.project = project
+        user.profile.save()
+        DeviceLatestStatus.objects.create(device=user.profile.device, last_seen=timezone.now(), power_plugged=True, battery_level=1.0)
+
+    return project
+
+
+def api_client(user):
+
+    # client authenticated as the user
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
+
+
+class StorageTestMixin:
+
+    # local storage in a temporary folder, holding the initial weights of a small model
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+
+        overridden = override_settings(DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage', MEDIA_ROOT=media_root)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+        modelregistry.clear_cache()
+        self.addCleanup(modelregistry.clear_cache)
+
+        self.initial_weights = np.arange(MODEL_SIZE, dtype=np.float32)
+        self.save(modelregistry.model_file('CIFAR10_B20'), self.initial_weights.tobytes())
+
+    def save(self, path, content):
+        filereplace(path, ContentFile(content))
+
+    def round_path(self, round, *paths):
+        return os.path.join(consts.PROJECTS_PATH, str(round.project_id), str(round.round_number), *paths)
+
+    def save_device_model(self, round, device_id, content):
+        self.save(self.round_path(round, str(device_id), consts.MODEL_WEIGHTS_FILENAME), content)
+
+    def read_weights(self, path):
+        with default_storage.open(path) as data:
+            return np.frombuffer(data.read(), dtype=np.float32)
+
+
+class StorageTestCase(StorageTestMixin, TestCase):
+    pass
+
+
+@mock.patch('api.models.filecopy')
+class SchedulerTest(TestCase):
+
+    def count_tick_queries(self, project):
+        with CaptureQueriesContext(connection) as queries:
+            scheduling.tick_project(project.id)
+        return len(queries)
+
+    def test_queries_independent_of_devices(self, filecopy):
+
+        # wait -> training (train request sent to every device)
+        small, large = create_project('small', 2), create_project('large', 40)
+        queries = self.count_tick_queries(small)
+        self.assertEqual(self.count_tick_queries(large), queries)
+        self.assertLessEqual(queries, MAX_TICK_QUERIES)
+        self.assertEqual(len(PushMessage.objects.get(train_request__round__project=large).users), 40)
+        self.assertEqual(large.rounds.last().status, Round.Status.TRAINING)
+
+        # training, waiting for responses
+        queries = self.count_tick_queries(small)
+        self.assertEqual(self.count_tick_queries(large), queries)
+        self.assertLessEqual(queries, MAX_TICK_QUERIES)
+
+    def test_repush_unacknowledged(self, filecopy):
+        project = create_project('repush', 3)
+        scheduling.tick_project(project.id)
+        round = project.rounds.last()
+
+        # one device joins the round, the others don't within PUSH_ACK_TIMEOUT
+        devices = [profile.device for profile in project.profiles.order_by('id')]
+        views.join_round(devices[0], project.id, str(round.round_number), JoinedRounds.Status.JOIN_ROUND)
+        TrainRequestDelivery.objects.update(last_push_date=timezone.now() - timedelta(hours=1))
+
+        scheduling.tick_project(project.id)
+        pushes = dict(TrainRequestDelivery.objects.values_list('device_id', 'pushes'))
+        self.assertEqual(pushes, {devices[0].id: 1, devices[1].id: 2, devices[2].id: 2})
+        self.assertEqual(PushMessage.objects.count(), 2)
+        self.assertIsNotNone(TrainRequestDelivery.objects.get(device=devices[0]).ack_date)
+
+        # deliveries reference the last message pushed to their device
+        messages = dict(TrainRequestDelivery.objects.values_list('device_id', 'message_id'))
+        self.assertEqual(messages[devices[1].id], PushMessage.objects.latest('id').id)
+        self.assertEqual(messages[devices[0].id], PushMessage.objects.earliest('id').id)
+
+
+@mock.patch('api.push_outbox.start')
+class SchedulerTransactionTest(StorageTestMixin, TransactionTestCase):
+
+    def trained_project(self, title):
+
+        # project whose round is training, all devices responded (completed by the next check)
+        project = create_project(title, 2)
+        scheduling.tick_project(project.id)
+        round = project.rounds.last()
+
+        for device in Device.objects.filter(profile__project=project):
+            DeviceStatusResponse.objects.create(device=device, device_train_request=round.device_train_request)
+
+        return project
+
+    def test_aggregation_outside_transaction(self, start):
+        project = self.trained_project('aggregation')
+
+        # while aggregating, the round is committed as complete (a concurrent upload is not queued for it,
+        # nor blocked waiting for its lock) and other checks skip the project
+        observed = []
+
+        def aggregate_model(round, into_round, verbose=False):
+            sc.fold_model(round, 1, ContentFile(np.ones(MODEL_SIZE, dtype=np.float32).tobytes()))
+            observed.append((
+                connection.in_atomic_block,
+                Round.objects.get(pk=round.pk).status,
+                Round.objects.get(pk=round.pk).pending_devices,
+                scheduling.tick_project(project.id)))
+
+        with mock.patch('api.server_control.aggregate_model', side_effect=aggregate_model):
+            self.assertTrue(scheduling.tick_project(project.id))
+
+        self.assertEqual(observed, [(False, Round.Status.COMPLETE, {}, False)])
+        self.assertIsNone(Project.objects.get(pk=project.pk).check_lease_date)
+
+    @override_settings(SCHEDULER_LEASE=0.3)
+    def test_lease_renewed(self, start):
+        project = self.trained_project('lease')
+
+        # an aggregation taking longer than the lease, the project stays claimed
+        observed = []
+
+        def aggregate_model(round, into_round, verbose=False):
+            lease_date = Project.objects.get(pk=project.pk).check_lease_date
+            time.sleep(0.5)
+            observed.append((Project.objects.get(pk=project.pk).check_lease_date > lease_date, scheduling.tick_project(project.id)))
+
+        with mock.patch('api.server_control.aggregate_model', side_effect=aggregate_model):
+            self.assertTrue(scheduling.tick_project(project.id))
+
+        self.assertEqual(observed, [(True, False)])
+        self.assertIsNone(Project.objects.get(pk=project.pk).check_lease_date)
+
+
+@mock.patch('api.models.filecopy')
+class SchedulerDaemonTest(TestCase):
+
+    def setUp(self):
+        self.project = create_project('daemon')
+        self.daemon = scheduling.Daemon(poll_interval=1, executor=ThreadPoolExecutor(max_workers=1))
+        self.addCleanup(self.daemon.executor.shutdown)
+
+    def poll(self):
+
+        # poll, and once the checks started are done, poll again to schedule their next check
+        timeout = self.daemon.poll()
+        if self.daemon.running:
+            self.daemon.wait(5)
+            timeout = self.daemon.poll()
+        return timeout
+
+    @mock.patch('api.scheduling.check_project')
+    def test_event(self, check_project, filecopy):
+        check_project.return_value = timezone.now() + timedelta(hours=1)
+
+        # projects in progress are checked on start, then at their deadline
+        self.poll()
+        self.poll()
+        self.assertEqual(check_project.call_count, 1)
+
+        # or as soon as one of their devices responds
+        SchedulerEvent.objects.create(project=self.project, reason='train-response')
+        self.poll()
+        self.assertEqual(check_project.call_count, 2)
+        self.assertFalse(SchedulerEvent.objects.exists())
+
+    @mock.patch('api.scheduling.check_project')
+    def test_deadline(self, check_project, filecopy):
+        check_project.return_value = timezone.now() + timedelta(seconds=0.2)
+
+        # the poll ends at the deadline, when the project is checked again
+        timeout = self.poll()
+        self.assertLessEqual(timeout, 0.2)
+        time.sleep(timeout)
+
+        check_project.return_value = None
+        self.poll()
+        self.poll()
+        self.assertEqual(check_project.call_count, 2)
+        self.assertEqual(self.daemon.deadlines, {})
+
+    def test_next_check_date(self, filecopy):
+        round = self.project.rounds.get()
+
+        # device availability is checked periodically while waiting, pushes are acknowledged while training
+        now = timezone.now()
+        self.assertAlmostEqual(scheduling.next_check_date(self.project), now + timedelta(seconds=settings.SCHEDULER_AVAILABILITY_INTERVAL), delta=timedelta(seconds=5))
+
+        Round.objects.filter(pk=round.pk).update(status=Round.Status.TRAINING, start_training_date=now)
+        self.assertAlmostEqual(scheduling.next_check_date(self.project), now + timedelta(seconds=settings.PUSH_ACK_TIMEOUT), delta=timedelta(seconds=5))
+
+        # until the round times out
+        Round.objects.filter(pk=round.pk).update(start_training_date=now - timedelta(minutes=self.project.max_training_time))
+        self.assertLessEqual(scheduling.next_check_date(self.project), now)
+
+        Project.objects.filter(pk=self.project.pk).update(status=Project.STATUS_CHOICES[2][0])
+        self.assertIsNone(scheduling.next_check_date(Project.objects.get(pk=self.project.pk)))
+
+
+class PushOutboxTest(TestCase):
+
+    def setUp(self):
+        self.server = FakePushwoosh().start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        overridden = override_settings(PUSHWOOSH_API_URL=self.server.url, PUSH_BATCH_SIZE=1000, PUSH_RETRY_BACKOFF=0)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+    def test_batches(self):
+        users = ['user_%d' % i for i in range(2500)]
+        push_outbox.send_data(users, {'type': 'train'}, 60)
+
+        self.assertEqual(push_outbox.flush(), 3)
+        self.assertEqual(PushMessage.objects.filter(status=PushMessage.Status.SENT).count(), 3)
+
+        sent = [user for _, request in self.server.requests for user in request['notifications'][0]['users']]
+        self.assertEqual(sorted(sent), sorted(users))
+        self.assertTrue(all(len(request['notifications'][0]['users']) <= 1000 for _, request in self.server.requests))
+
+    def test_message_ids(self):
+
+        # set on databases that don't return the ids of bulk inserts (like SQLite with Django 3.2)
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert', False):
+            messages = push_outbox.send_data(['user_%d' % i for i in range(1500)], {'type': 'train'}, 60)
+
+        self.assertEqual(len(messages), 2)
+        self.assertEqual([message.id for message in messages], list(PushMessage.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_retries(self):
+        self.server.failures = 1
+        message, = push_outbox.send_data(['user'], {'type': 'train'}, 60)
+
+        push_outbox.flush()
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (PushMessage.Status.SENT, 2))
+
+
+class IngestionTest(TestCase):
+
+    def setUp(self):
+        self.device = User.objects.create_user(username='ingestion').profile.device
+
+        # the background thread isn't started (flushed explicitly)
+        patched = mock.patch('api.ingestion.threading.Thread')
+        patched.start()
+        self.addCleanup(patched.stop)
+
+    def ping(self, details):
+        return views.report_availability(self.device, {'request_type': 'device-ping', 'device_info': {'device_details': details}})
+
+    def test_buffered(self):
+        responses = BulkBuffer(DeviceStatusResponse, 3, 1000)
+        for _ in range(3):
+            responses.add(DeviceStatusResponse(device=self.device))
+
+        # full, the request adding the last row only wakes up the background thread
+        self.assertTrue(responses._wakeup.is_set())
+        self.assertEqual(DeviceStatusResponse.objects.count(), 0)
+
+        self.assertEqual(responses.flush(), 3)
+        self.assertEqual(DeviceStatusResponse.objects.count(), 3)
+
+    def test_failed_flush(self):
+        responses = BulkBuffer(DeviceStatusResponse, 3, 1000)
+        rows = [DeviceStatusResponse(device=self.device, battery_level=i) for i in range(3)]
+        for row in rows:
+            responses.add(row)
+
+        # rows are saved one by one, only the invalid one is lost
+        rows[1].save = mock.Mock(side_effect=DatabaseError('invalid row'))
+        with mock.patch.object(DeviceStatusResponse.objects, 'bulk_create', side_effect=DatabaseError('invalid row')):
+            responses.flush()
+
+        self.assertEqual(sorted(DeviceStatusResponse.objects.values_list('battery_level', flat=True)), [0, 2])
+        self.assertEqual(responses.flush(), 0)
+
+    def test_unchanged_details(self):
+        details = {'model': 'Pixel', 'os': 'Android', 'version': '13'}
+
+        # saved when reported for the first time or when they change
+        with mock.patch.object(Device, 'save') as save:
+            self.ping(details)
+            self.ping(dict(reversed(list(details.items()))))
+            self.assertEqual(save.call_count, 1)
+
+            self.ping(dict(details, version='14'))
+            self.assertEqual(save.call_count, 2)
+        self.assertEqual(self.device.os_version, '14')
+
+
+class DeltaResolutionTest(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.project = create_project('deltas')
+        self.round = self.project.rounds.get()
+        self.base_path = self.round_path(self.round, consts.MODEL_WEIGHTS_FILENAME)
+
+    def test_delta_and_sparse_updates(self):
+        delta = np.full(MODEL_SIZE, 2, dtype=np.float32)
+        self.save_device_model(self.round, 1, modelformat.encode(delta, kind='delta'))
+        self.save_device_model(self.round, 2, modelformat.encode([4], kind='sparse', indices=[3], size=MODEL_SIZE))
+
+        model = get_aggregator(self.project).aggregate(self.round, [1, 2], self.base_path)
+
+        expected = self.initial_weights + (delta + np.eye(MODEL_SIZE, dtype=np.float32)[3] * 4) / 2
+        np.testing.assert_allclose(model.weights, expected)
+
+    def test_missing_base_model(self):
+        device = User.objects.create_user(username='deltas').profile.device
+        train_request = DeviceTrainRequest.objects.create(round=self.round)
+        DeviceStatusResponse.objects.create(device=device, device_train_request=train_request)
+
+        self.save_device_model(self.round, device.id, modelformat.encode(np.ones(MODEL_SIZE), kind='delta'))
+        default_storage.delete(self.base_path)
+
+        self.assertIsNone(get_aggregator(self.project).aggregate(self.round, [device.id], self.base_path))
+
+        # the next round keeps the model of the round instead of the averaged deltas
+        next_round = Round.objects.create(project=self.project, round_number=1, number_of_samples=1, number_of_epochs=1, seed=0)
+        sc.aggregate_model(self.round, next_round)
+        self.assertEqual(next_round.model_round_number, 0)
+
+
+class ModelFormatTest(TestCase):
+
+    def setUp(self):
+        self.weights = np.linspace(-1, 1, 64, dtype=np.float32)
+
+    def test_round_trip(self):
+        tolerances = {'FLOAT32': 0, 'FLOAT16': 1e-3, 'INT8': 1 / 127}
+        for model_format, tolerance in tolerances.items():
+            for compression in modelformat.COMPRESSIONS:
+                with self.subTest(model_format=model_format, compression=compression):
+                    content = modelformat.encode(self.weights, model_format, compression, tensors=[16, 48])
+                    header, _ = modelformat.decode_header(content)
+                    self.assertEqual((header['dtype'], header['compression']), (model_format, compression))
+                    np.testing.assert_allclose(modelformat.decode(content), self.weights, atol=tolerance)
+
+    def test_sparse_round_trip(self):
+        indices, values = modelformat.topk(self.weights, 4)
+        update = modelformat.decode_update(modelformat.encode(values, 'FLOAT16', 'DEFLATE', kind='sparse', indices=indices, size=64))
+
+        self.assertEqual((update.kind, update.size), ('sparse', 64))
+        np.testing.assert_array_equal(update.indices, [0, 1, 62, 63])
+        np.testing.assert_allclose(update.values, values, atol=1e-3)
+
+    def test_malformed(self):
+        content = modelformat.encode(self.weights, 'INT8', 'DEFLATE')
+        header, start = modelformat.decode_header(content)
+
+        def container(**changes):
+            changed = dict(header, **changes)
+            changed = {key: value for key, value in changed.items() if value is not None}
+            changed = json.dumps(changed).encode('utf-8')
+            return modelformat.PREAMBLE.pack(modelformat.MAGIC, modelformat.VERSION, len(changed)) + changed + content[start:]
+
+        malformed = {
+            'truncated preamble': modelformat.MAGIC + b'\x01',
+            'truncated header': content[:start - 1],
+            'header not an object': modelformat.PREAMBLE.pack(modelformat.MAGIC, modelformat.VERSION, 2) + b'[]',
+            'corrupt payload': content[:start] + b'\x00' + content[start + 1:],
+            'missing compression': container(compression=None),
+            'missing checksum': container(checksum=None),
+            'missing size': container(size=None),
+            'missing scales': container(scales=None),
+            'unknown dtype': container(dtype='FLOAT64'),
+            'wrong tensors': container(tensors=[1]),
+            'corrupt zstd payload': container(compression='ZSTD'),
+        }
+        for name, data in malformed.items():
+            with self.subTest(name):
+                with self.assertRaises(ValueError):
+                    modelformat.decode_update(data)
+
+
+class ModelUrlCacheTest(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.project = create_project('urls')
+        self.client = api_client(User.objects.create_user(username='urls'))
+
+    def get_model(self, round):
+        return self.client.get(reverse('get-model', args=[self.project.id, round]))
+
+    def test_round_normalized(self):
+        response = self.get_model('00')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(cache.get(urlcache.model_key(self.project.id, 0)), response['Location'])
+        self.assertEqual(self.get_model('0')['Location'], response['Location'])
+
+        self.assertEqual(self.get_model('first').status_code, 404)
+
+    def test_reset_forgets_all_rounds(self):
+        Project.objects.filter(pk=self.project.pk).update(current_round=2)
+        self.project.refresh_from_db()
+        for round in range(3):
+            cache.set(urlcache.model_key(self.project.id, round), 'url')
+            cache.set(urlcache.etag_key(self.project.id, round), '"etag"')
+
+        sc.reset_project(self.project)
+
+        for round in range(3):
+            self.assertIsNone(cache.get(urlcache.model_key(self.project.id, round)))
+            self.assertIsNone(cache.get(urlcache.etag_key(self.project.id, round)))
+
+
+class ModelRegistryTest(StorageTestCase):
+
+    def save_metadata(self, metadata):
+        self.save(modelregistry.metadata_file('CIFAR10_B20'), json.dumps(metadata).encode('utf-8'))
+
+    def test_layers(self):
+        self.save_metadata({'layers': [{'name': 'kernel', 'shape': [2, 3]}, {'name': 'bias', 'shape': [2]}]})
+
+        spec = modelregistry.get_spec('CIFAR10_B20')
+        self.assertEqual(spec.size, MODEL_SIZE)
+        self.assertEqual([(layer.name, layer.shape) for layer in spec.layers], [('kernel', (2, 3)), ('bias', (2,))])
+
+    def test_invalid(self):
+        invalid = {
+            'missing layers': {},
+            'missing shape': {'layers': [{'name': 'kernel'}]},
+            'invalid shape': {'layers': [{'shape': ['two', 4]}]},
+            'mismatched size': {'layers': [{'shape': [2, 2]}]},
+        }
+        for name, metadata in invalid.items():
+            with self.subTest(name):
+                self.save_metadata(metadata)
+                with self.assertRaisesRegex(ValueError, "model 'CIFAR10_B20'"):
+                    modelregistry.get_spec('CIFAR10_B20')
+
+        with self.assertRaisesRegex(ValueError, "model 'MISSING'"):
+            modelregistry.get_spec('MISSING')
+
+
+class ModelCacheTest(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+        overridden = override_settings(MODEL_CACHE_DIR=self.cache_dir, MODEL_CACHE_SIZE=MODEL_SIZE * 4)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+    def test_failed_load(self):
+        with self.assertRaises(OSError):
+            modelcache._load('models/MISSING.bin', os.path.join(self.cache_dir, 'missing.bin'))
+
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_stats(self):
+
+        # counts of every worker add up (none counted by this process yet)
+        patched = mock.patch.dict(modelcache._stats, {'hits': 0, 'misses': 0})
+        patched.start()
+        self.addCleanup(patched.stop)
+
+        for _ in range(modelcache.FLUSH_EVERY - 1):
+            modelcache._count('hits')
+        modelcache._count('misses')
+        modelcache.add_model_cache_counts({'hits': 10, 'misses': 0})
+        self.assertEqual(modelcache.get_stats(), {'hits': modelcache.FLUSH_EVERY + 9, 'misses': 1})
+
+        modelcache.reset_stats()
+        self.assertEqual(modelcache.get_stats(), {'hits': 0, 'misses': 0})
+
+    def test_evict_vanished(self):
+        for name in ('old', 'new'):
+            modelcache._load(modelregistry.model_file('CIFAR10_B20'), os.path.join(self.cache_dir, name + '.bin'))
+        os.utime(os.path.join(self.cache_dir, 'old.bin'), (0, 0))
+
+        # the kept model was evicted by another worker meanwhile
+        modelcache._evict(keep=os.path.join(self.cache_dir, 'gone.bin'))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['new.bin'])
+
+
+@mock.patch('api.models.filecopy')
+class ProjectDeletionTest(TestCase):
+
+    def test_files_deleted_on_commit(self, filecopy):
+        project = create_project('deletion')
+
+        with mock.patch('api.server_control.delete_project') as delete_project:
+            with self.captureOnCommitCallbacks(execute=True):
+                project.delete()
+                delete_project.assert_not_called()
+
+        delete_project.assert_called_once_with(project, background=True)
+
+
+class BackfillResponsesTest(TestCase):
+
+    def test_batches(self):
+        device = User.objects.create_user(username='backfill').profile.device
+
+        # historic responses (typed columns not filled on ingest), one without any typed field in its data,
+        # and a recent one (filled already)
+        levels = [0.1, 0.2, None, 0.4, 0.5]
+        historic = [
+            DeviceStatusResponse.objects.create(device=device, data={'battery_status': {'level': level}} if level is not None else {}).id
+            for level in levels]
+        DeviceStatusResponse.objects.create(device=device, battery_level=1.0)
+
+        bulk_update = DeviceStatusResponse.objects.bulk_update
+        with mock.patch.object(DeviceStatusResponse.objects, 'bulk_update', side_effect=bulk_update) as updated:
+            with mock.patch('builtins.print'):
+                call_command('backfillresponses', '--batch-size', '2')
+
+        # in 3 batches, each response visited once
+        visited = [response.id for call in updated.call_args_list for response in call.args[0]]
+        self.assertEqual(updated.call_count, 3)
+        self.assertEqual(visited, historic)
+
+        filled = dict(DeviceStatusResponse.objects.filter(id__in=historic).values_list('id', 'battery_level'))
+        self.assertEqual([filled[response_id] for response_id in historic], levels)
+
+
+class RetentionTest(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.device = User.objects.create_user(username='retention').profile.device
+
+        # expired pings in two hours, and a recent one
+        hour = (timezone.now() - timedelta(days=40)).replace(minute=0, second=0, microsecond=0)
+        for minutes, plugged, level in [(0, True, 0.5), (10, False, 0.7), (70, True, 0.9)]:
+            ping = DeviceStatusResponse.objects.create(device=self.device, power_plugged=plugged, battery_level=level)
+            DeviceStatusResponse.objects.filter(pk=ping.pk).update(create_date=hour + timedelta(minutes=minutes))
+        DeviceStatusResponse.objects.create(device=self.device, power_plugged=True, battery_level=1.0)
+        self.hour = hour
+
+    def archived(self):
+        paths = []
+        for root, _, files in os.walk(default_storage.path(consts.STATUS_ARCHIVE_PATH)):
+            paths += [os.path.join(root, name) for name in files]
+        return paths
+
+    def test_rollup_and_archive(self):
+        self.assertEqual(retention.apply(batch_size=2), 3)
+
+        rollups = DeviceStatusRollup.objects.order_by('hour')
+        self.assertEqual(
+            [(rollup.hour, rollup.responses, rollup.plugged_responses, rollup.min_battery_level, rollup.max_battery_level) for rollup in rollups],
+            [(self.hour, 2, 1, 0.5, 0.7), (self.hour + timedelta(hours=1), 1, 1, 0.9, 0.9)])
+        self.assertEqual(DeviceStatusResponse.objects.count(), 1)
+
+        archived = []
+        for path in self.archived():
+            with gzip.open(path) as file:
+                archived += [json.loads(line)['id'] for line in file]
+        self.assertEqual(len(archived), 3)
+
+    def test_retry_replaces_archive(self):
+        with mock.patch('api.retention.__rollup', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                retention.apply()
+        self.assertEqual(DeviceStatusResponse.objects.count(), 4)
+
+        retention.apply()
+        self.assertEqual(len(self.archived()), 1)
+        self.assertEqual(DeviceStatusResponse.objects.count(), 1)
+
+
+class AggregationTest(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.project = create_project('aggregation')
+        self.round = self.project.rounds.get()
+        self.base_path = self.round_path(self.round, consts.MODEL_WEIGHTS_FILENAME)
+
+        # models of 5 devices
+        self.device_ids = list(range(1, 6))
+        self.models = np.random.RandomState(0).uniform(-1, 1, (len(self.device_ids), MODEL_SIZE)).astype(np.float32)
+        for device_id, weights in zip(self.device_ids, self.models):
+            self.save_device_model(self.round, device_id, weights.tobytes())
+
+    def aggregate(self, strategy, **fields):
+        Project.objects.filter(pk=self.project.pk).update(aggregation_strategy=strategy, **fields)
+        self.project.refresh_from_db()
+
+        aggregator = get_aggregator(self.project)
+        model = aggregator.aggregate(self.round, self.device_ids, self.base_path)
+        return aggregator.update(model, self.base_path).weights
+
+    @override_settings(AGGREGATION_CHUNK_SIZE=10)
+    def test_chunked(self):
+
+        # blocks of 2 weights, from memory-mapped files and from streamed chunks (non-local storages)
+        np.testing.assert_allclose(self.aggregate('FEDAVG'), self.models.mean(axis=0), rtol=1e-6)
+        with mock.patch('api.mlmodel.mapfile', return_value=None):
+            np.testing.assert_allclose(self.aggregate('FEDAVG'), self.models.mean(axis=0), rtol=1e-6)
+
+    def test_weighted(self):
+        samples = [10, 20, 30, 40, 100]
+        for device_id, count in zip(self.device_ids, samples):
+            self.save(self.round_path(self.round, str(device_id), consts.PERFORMANCE_FILENAME), json.dumps({'number_of_samples': count}).encode('utf-8'))
+
+        np.testing.assert_allclose(self.aggregate('WEIGHTED_FEDAVG'), np.average(self.models, axis=0, weights=samples), rtol=1e-6)
+
+    def test_median(self):
+        np.testing.assert_allclose(self.aggregate('MEDIAN'), np.median(self.models, axis=0))
+
+    def test_trimmed_mean(self):
+
+        # the largest and smallest value of each weight are dropped
+        expected = np.sort(self.models, axis=0)[1:-1].mean(axis=0)
+        np.testing.assert_allclose(self.aggregate('TRIMMED_MEAN', trim_ratio='0.20'), expected, rtol=1e-6)
+
+    def test_unusable(self):
+
+        # no device model is usable (incorrect length), the round keeps its model instead of a zero model
+        for device_id in self.device_ids:
+            self.save_device_model(self.round, device_id, b'\0' * 12)
+
+        for strategy in ['FEDAVG', 'WEIGHTED_FEDAVG', 'MEDIAN', 'TRIMMED_MEAN', 'FEDADAM']:
+            with self.subTest(strategy):
+                Project.objects.filter(pk=self.project.pk).update(aggregation_strategy=strategy)
+                self.project.refresh_from_db()
+                self.assertIsNone(get_aggregator(self.project).aggregate(self.round, self.device_ids, self.base_path))
+
+    def test_server_optimizers(self):
+        lr, beta1, beta2, tau = 0.1, 0.9, 0.99, 0.001
+        delta = self.models.mean(axis=0).astype(np.float64) - self.initial_weights
+        m = (1 - beta1) * delta
+
+        second_moments = {
+            'FEDADAM': beta2 * tau ** 2 + (1 - beta2) * delta ** 2,
+            'FEDYOGI': tau ** 2 - (1 - beta2) * delta ** 2 * np.sign(tau ** 2 - delta ** 2),
+        }
+        for strategy, v in second_moments.items():
+            with self.subTest(strategy):
+                default_storage.delete(os.path.join(consts.PROJECTS_PATH, str(self.project.id), consts.OPTIMIZER_STATE_FILENAME))
+
+                weights = self.aggregate(strategy, server_learning_rate=lr, server_beta1=beta1, server_beta2=beta2, server_tau=tau)
+                np.testing.assert_allclose(weights, self.initial_weights + lr * m / (np.sqrt(v) + tau), rtol=1e-5)
+
+
+class FoldTest(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.project = create_project('fold')
+        self.round = self.project.rounds.get()
+        Round.objects.filter(pk=self.round.pk).update(status=Round.Status.TRAINING)
+        self.partial_path = self.round_path(self.round, consts.PARTIAL_WEIGHTS_FILENAME)
+
+    def upload(self, device_id, weights):
+        round = Round.objects.get(pk=self.round.pk)
+        sc.fold_model(round, device_id, ContentFile(np.asarray(weights, dtype=np.float32).tobytes()))
+        return Round.objects.get(pk=self.round.pk)
+
+    def fold_uploads(self):
+        return sc.fold_uploads(self.round)
+
+    def partial(self):
+        with default_storage.open(self.partial_path) as data:
+            return np.frombuffer(data.read(), dtype=settings.AGGREGATION_DTYPE)
+
+    def test_queued(self):
+
+        # uploads only queue their model, the running sum is updated by the scheduler
+        round = self.upload(1, np.ones(MODEL_SIZE))
+        self.assertEqual((list(round.pending_devices), round.partial_devices), (['1'], {}))
+        self.assertFalse(default_storage.exists(self.partial_path))
+
+        round = self.fold_uploads()
+        self.assertEqual((round.pending_devices, list(round.partial_devices)), ({}, ['1']))
+        np.testing.assert_array_equal(self.partial(), np.ones(MODEL_SIZE))
+
+    def test_idempotent(self):
+        ones, twos, threes = np.ones(MODEL_SIZE), np.full(MODEL_SIZE, 2), np.full(MODEL_SIZE, 3)
+
+        self.upload(1, ones)
+        self.fold_uploads()
+        self.upload(1, ones)
+        round = self.fold_uploads()
+        self.assertEqual(list(round.partial_devices), ['1'])
+        np.testing.assert_array_equal(self.partial(), ones)
+
+        # a new upload of a device replaces its contribution (also if uploaded again before being folded)
+        self.upload(1, twos)
+        self.upload(1, threes)
+        self.upload(2, ones)
+        round = self.fold_uploads()
+        self.assertTrue(round.partial_valid)
+        self.assertEqual(sorted(round.partial_devices), ['1', '2'])
+        np.testing.assert_array_equal(self.partial(), threes + ones)
+        self.assertFalse(default_storage.exists(self.round_path(round, '1', consts.MODEL_WEIGHTS_FILENAME + consts.PREVIOUS_SUFFIX)))
+
+    def test_invalidation(self):
+        self.upload(1, np.ones(MODEL_SIZE))
+        self.fold_uploads()
+
+        # the running sum can't be restored (the round is aggregated from the device models instead)
+        default_storage.delete(self.partial_path)
+        self.upload(2, np.ones(MODEL_SIZE))
+        round = self.fold_uploads()
+        self.assertFalse(round.partial_valid)
+        self.assertEqual(list(round.partial_devices), ['1'])
+
+        # uploads are still saved, but not queued anymore
+        round = self.upload(3, np.ones(MODEL_SIZE))
+        self.assertEqual(round.pending_devices, {})
+        self.assertTrue(default_storage.exists(self.round_path(round, '3', consts.MODEL_WEIGHTS_FILENAME)))
+
+    def test_complete_round(self):
+        Round.objects.filter(pk=self.round.pk).update(status=Round.Status.COMPLETE)
+
+        round = self.upload(1, np.ones(MODEL_SIZE))
+        self.assertEqual(round.pending_devices, {})
+        self.assertFalse(default_storage.exists(self.partial_path))
+
+
+@override_settings(MODEL_SERVING='direct')
+class ModelServingTest(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.project = create_project('serving')
+        self.client = api_client(User.objects.create_user(username='serving'))
+        self.content = self.initial_weights.tobytes()
+        self.etag = '"%s"' % hashlib.sha1(self.content).hexdigest()
+
+    def get_model(self, **headers):
+        response = self.client.get(reverse('get-model', args=[self.project.id, '0']), **headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_conditional_get(self):
+        response, body = self.get_model()
+        self.assertEqual((response.status_code, body, response['ETag']), (200, self.content, self.etag))
+
+        response, _ = self.get_model(HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(response.status_code, 304)
+
+        response, body = self.get_model(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual((response.status_code, body), (200, self.content))
+
+    def test_range(self):
+        size = len(self.content)
+
+        response, body = self.get_model(HTTP_RANGE='bytes=4-11')
+        self.assertEqual((response.status_code, body, response['Content-Range']), (206, self.content[4:12], 'bytes 4-11/%d' % size))
+
+        response, body = self.get_model(HTTP_RANGE='bytes=-4')
+        self.assertEqual((response.status_code, body), (206, self.content[-4:]))
+
+        response, _ = self.get_model(HTTP_RANGE='bytes=%d-' % size)
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */%d' % size))
+
+        # the model changed since the partial download started
+        response, body = self.get_model(HTTP_RANGE='bytes=4-11', HTTP_IF_RANGE='"other"')
+        self.assertEqual((response.status_code, body), (200, self.content))
+
+
+class UploadTest(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.project = create_project('uploads')
+        self.round = self.project.rounds.get()
+
+        user = User.objects.create_user(username='uploads')
+        self.device = user.profile.device
+        self.client = api_client(user)
+
+        self.model_path = self.round_path(self.round, str(self.device.id), consts.MODEL_WEIGHTS_FILENAME)
+
+    def request_upload(self, filename=consts.MODEL_WEIGHTS_FILENAME):
+        return self.client.post(reverse('request-upload', args=[self.project.id, '0', filename])).data
+
+    def test_signed_upload(self):
+        upload = self.request_upload()
+        self.assertEqual((upload['method'], upload['content_type']), ('PUT', 'application/octet-stream'))
+
+        # anyone with the url can upload (it is signed), the model is moved in place once completed
+        response = APIClient().put(upload['url'], self.initial_weights.tobytes(), content_type=upload['content_type'])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(default_storage.exists(self.model_path))
+
+        response = self.client.post(reverse('complete-upload', args=[self.project.id, '0', consts.MODEL_WEIGHTS_FILENAME]))
+        self.assertEqual(response.status_code, 201)
+        np.testing.assert_array_equal(self.read_weights(self.model_path), self.initial_weights)
+
+    def test_invalid_upload_url(self):
+        upload = self.request_upload()
+
+        response = APIClient().put(upload['url'] + 'x', b'weights', content_type=upload['content_type'])
+        self.assertEqual(response.status_code, 403)
+
+        with override_settings(UPLOAD_URL_EXPIRY=-1):
+            response = APIClient().put(upload['url'], b'weights', content_type=upload['content_type'])
+        self.assertEqual(response.status_code, 403)
+
+    def submit_model(self, content):
+        return self.client.post(
+            reverse('submit-model', args=[self.project.id, '0', consts.MODEL_WEIGHTS_FILENAME]),
+            content, content_type='application/octet-stream',
+            HTTP_CONTENT_DISPOSITION='attachment; filename=%s' % consts.MODEL_WEIGHTS_FILENAME)
+
+    def test_model_size(self):
+        weights = self.initial_weights.tobytes()
+
+        # raw weights must have the size of the model (containers are checked when decoded)
+        for content in (weights[:-4], weights + weights, b'x' * (3 * len(weights) + uploads.ModelUploadHandler.CONTAINER_OVERHEAD)):
+            with self.subTest(length=len(content)):
+                self.assertEqual(self.submit_model(content).status_code, 400)
+                self.assertFalse(default_storage.exists(self.model_path))
+
+        self.assertEqual(self.submit_model(weights).status_code, 201)
+        np.testing.assert_array_equal(self.read_weights(self.model_path), self.initial_weights)
+
+        self.assertEqual(self.submit_model(modelformat.encode(self.initial_weights, 'FLOAT16')).status_code, 201)
+
+
+class AsyncViewsTest(StorageTestMixin, TransactionTestCase):
+
+    # device-facing endpoints served through ASGI (run in threads of their own, so rows are committed)
+    def setUp(self):
+        super().setUp()
+        self.project = create_project('async')
+
+        self.user = User.objects.create_user(username='async')
+        self.device = self.user.profile.device
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+
+    def request(self, method, path, authenticated=True, **extra):
+        if authenticated:
+            extra['authorization'] = 'Bearer ' + self.token
+        return async_to_sync(getattr(AsyncClient(), method))(path, **extra)
+
+    def test_routed_to_async_views(self):
+        path = reverse('join-round', args=[self.project.id, '0'])
+
+        response = self.request('get', path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.resolver_match.func, async_views.join_round)
+        self.assertTrue(JoinedRounds.objects.filter(device=self.device, round__project=self.project).exists())
+
+        # WSGI requests keep the sync views
+        self.assertNotEqual(api_client(self.user).get(path).resolver_match.func, async_views.join_round)
+
+    def test_unauthenticated(self):
+        response = self.request('get', reverse('join-round', args=[self.project.id, '0']), authenticated=False)
+        self.assertEqual(response.status_code, 401)
+
+    def test_missing_round(self):
+        self.assertEqual(self.request('get', reverse('join-round', args=[self.project.id, '5'])).status_code, 404)
+        self.assertEqual(self.request('get', reverse('get-model', args=[self.project.id + 1, '0'])).status_code, 404)
+
+    def test_ping(self):
+        data = {'request_type': 'device-ping', 'device_info': {'device_details': {'os': 'Android'}, 'battery_status': {'level': 0.5}}}
+        response = self.request('post', reverse('report-availability'), data=json.dumps(data), content_type='application/json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(DeviceLatestStatus.objects.get(device=self.device).battery_level, 0.5)
@@ -1,7 +1,7 @@
 from django.urls import path
 from rest_framework_simplejwt import views as jwt_views
 
-from api.views import ProjectList, ProjectDetail, GetSamples, ReportAvailibility, GetModel, JoinRound, SubmitModel, SubmitResults, ComputePerformance
+from api.views import ProjectList, ProjectDetail, GetSamples, ReportAvailibility, GetModel, GetRoundUrls, JoinRound, SubmitModel, SubmitResults, RequestUpload, CompleteUpload, LocalUpload, ComputePerformance
 
 urlpatterns = [
 
@@ -12,6 +12,7 @@ urlpatterns = [
     path('project/', ProjectList.as_view(), name='project-list'),
     path('project/<int:project_id>/', ProjectDetail.as_view(), name='project-details'),
     path('project/<int:project_id>/get-model/<str:round>/', GetModel.as_view(), name='get-model'),
+    path('project/<int:project_id>/get-round-urls/<str:round>/', GetRoundUrls.as_view(), name='get-round-urls'),
     path('project/<int:project_id>/join-round/<str:round>/', JoinRound.as_view(), name='join-round'),
 
     # Reporting
@@ -19,6 +20,11 @@ urlpatterns = [
     path('project/<int:project_id>/submit-results/<str:round>/<str:filename>', SubmitResults.as_view(), name='submit-results'),
     path('project/<int:project_id>/submit-model/<str:round>/<str:filename>', SubmitModel.as_view(), name='submit-model'),
 
+    # Direct uploads
+    path('project/<int:project_id>/request-upload/<str:round>/<str:filename>', RequestUpload.as_view(), name='request-upload'),
+    path('project/<int:project_id>/complete-upload/<str:round>/<str:filename>', CompleteUpload.as_view(), name='complete-upload'),
+    path('upload/<str:token>', LocalUpload.as_view(), name='local-upload'),
+
     # JWT Tokens
     path('token/', jwt_views.TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', jwt_views.TokenRefreshView.as_view(), name='token_refresh'),
@@ -1,9 +1,14 @@
 import os
+import json
+import hashlib
 
 from api.models import Project, DeviceTrainRequest, DeviceStatusResponse, Round, JoinedRounds
+from api.models import SchedulerEvent, device_status_fields, record_latest_status, acknowledge_train_request
 from api.serializers import ProjectSerializer, RoundSerializer  # , DeviceResponseSerializer
 
+from django.conf import settings
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
 from django.http import Http404, HttpResponseRedirect
 from django.core.files.storage import default_storage
 
@@ -13,10 +18,16 @@ from rest_framework.response import Response
 from rest_framework.parsers import FileUploadParser
 from rest_framework import status
 from rest_framework import renderers
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, AllowAny
 
-from api.libs import consts
+from django.core import signing
+
+from api.libs import consts, uploads, urlcache, serving, modelcache, modelregistry
+from api.mlmodel import WEIGHTS_DTYPE
+from api.libs.filemanagement import filecopy
 from api.mlreport import MLReport
+from api import server_control as sc
+from api.ingestion import BulkBuffer
 
 
 class ProjectList(APIView):
@@ -58,6 +69,103 @@ class ModelUploadParser(FileUploadParser):
     media_type = 'application/octet-stream'
 
 
+def round_number(round):
+
+    # round of a url as a number ('05' is round 5, like the cached urls of the round), 404 if not a number
+    try:
+        return int(round)
+    except ValueError:
+        raise Http404
+
+
+def resolve_model_path(project_id, round):
+
+    # model of the round (it may reference the model of an earlier round)
+    round_model = Round.objects.filter(project_id=project_id, round_number=round).first()
+
+    if round_model is not None:
+        return sc.model_path(round_model)
+    return os.path.join(consts.PROJECTS_PATH, str(project_id), str(round), consts.MODEL_WEIGHTS_FILENAME)
+
+
+def resolve_model_etag(project_id, round):
+
+    # checksum of the model of the round (None if the round or its model doesn't exist)
+    round_model = Round.objects.filter(project_id=project_id, round_number=round).first()
+
+    if round_model is None:
+        return None
+
+    checksum = sc.model_checksum(round_model)
+    return '"%s"' % checksum if checksum else None
+
+
+def resolve_samples_path(dataset_type, samples_index, app):
+    return os.path.join(consts.SAMPLES_PATH, dataset_type, str(samples_index), str(app), consts.SAMPLES_FILENAME)
+
+
+def samples_response(device, dataset_type, app):
+
+    # redirect to the samples of an app for the device
+    samples_index = device.samples_index
+
+    url = urlcache.cached_url(
+        urlcache.samples_key(dataset_type, samples_index, app),
+        lambda: resolve_samples_path(dataset_type, samples_index, app))
+    if url is not None:
+        return HttpResponseRedirect(url)
+        # with default_storage.open(file) as data:
+        #     return Response(
+        #         data.read(),
+        #         headers={'Content-Disposition': 'attachment; filename="%s"' % consts.SAMPLES_FILENAME})
+
+    else:
+        raise Http404
+
+
+def model_response(request, project_id, round):
+
+    round = round_number(round)
+
+    # the device may already have the model of the round (e.g. when retrying)
+    etag = urlcache.cached(urlcache.etag_key(project_id, round), lambda: resolve_model_etag(project_id, round))
+    if etag is not None:
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            return response
+
+    # serve the model (supports HTTP Range for resumable downloads), from the storage or
+    # from a local disk cache shared by all rounds and projects (loaded once per model)
+    if settings.MODEL_SERVING in ('direct', 'cached'):
+        try:
+            if settings.MODEL_SERVING == 'cached' and etag is not None:
+                data = modelcache.open_model(resolve_model_path(project_id, round), etag.strip('"'))
+                size = os.fstat(data.fileno()).st_size
+            else:
+                data = default_storage.open(resolve_model_path(project_id, round))
+                size = data.size
+        except (OSError, IOError):
+            raise Http404
+        return serving.file_response(request, data, size, etag, consts.MODEL_WEIGHTS_FILENAME)
+
+    # or redirect to the storage, cached per round (no database or storage round-trips once resolved)
+    url = urlcache.cached_url(
+        urlcache.model_key(project_id, round),
+        lambda: resolve_model_path(project_id, round))
+    if url is not None:
+        response = HttpResponseRedirect(url)
+        if etag is not None:
+            response['ETag'] = etag
+        return response
+        # with default_storage.open(file) as data:
+        #     return Response(
+        #         data.read(),
+        #         headers={'Content-Disposition': 'attachment; filename="%s"' % consts.MODEL_WEIGHTS_FILENAME})
+
+    else:
+        raise Http404
+
+
 class GetSamples(APIView):
     permission_classes = (IsAuthenticated,)
     renderer_classes = [ModelRenderer]
@@ -66,51 +174,18 @@ class GetSamples(APIView):
 
         # Get device (should have used a serializer)
         device = request.user.profile.device
-        samples_index = device.samples_index
-
-        file = os.path.join(consts.SAMPLES_PATH, dataset_type, str(samples_index), str(app), consts.SAMPLES_FILENAME)
-        if default_storage.exists(file):
-            url = default_storage.url(file)
-            return HttpResponseRedirect(url)
-            # with default_storage.open(file) as data:
-            #     return Response(
-            #         data.read(),
-            #         headers={'Content-Disposition': 'attachment; filename="%s"' % consts.SAMPLES_FILENAME})
-
-        else:
-            raise Http404
+        return samples_response(device, dataset_type, app)
 
 
 class GetModel(APIView):
     permission_classes = (IsAuthenticated,)
     renderer_classes = [ModelRenderer]
 
-    def get_project(self, project_id):
-        try:
-            return Project.objects.get(pk=project_id)
-
-        except Project.DoesNotExist:
-            raise Http404
-
     def get(self, request, project_id, round):
+        return model_response(request, project_id, round)
 
-        # not needed, just to check that project exists
-        self.get_project(project_id)
 
-        file = os.path.join(consts.PROJECTS_PATH, str(project_id), str(round), consts.MODEL_WEIGHTS_FILENAME)
-        if default_storage.exists(file):
-            url = default_storage.url(file)
-            return HttpResponseRedirect(url)
-            # with default_storage.open(file) as data:
-            #     return Response(
-            #         data.read(),
-            #         headers={'Content-Disposition': 'attachment; filename="%s"' % consts.MODEL_WEIGHTS_FILENAME})
-
-        else:
-            raise Http404
-
-
-class JoinRound(APIView):
+class GetRoundUrls(APIView):
     permission_classes = (IsAuthenticated,)
 
     def get_project(self, project_id):
@@ -120,82 +195,110 @@ class JoinRound(APIView):
         except Project.DoesNotExist:
             raise Http404
 
-    def get_round(self, project, round_number):
-        try:
-            return Round.objects.get(
-                project=project,
-                round_number=round_number)
-
-        except Project.DoesNotExist:
-            raise Http404
-
     def get(self, request, project_id, round):
 
-        # get project
+        # everything a device needs for a round in a single request: the model and the samples of its apps
         project = self.get_project(project_id)
+        round = round_number(round)
+        samples_index = request.user.profile.device.samples_index
+        dataset_type = project.dataset_type
+
+        model_url = urlcache.cached_url(
+            urlcache.model_key(project_id, round),
+            lambda: resolve_model_path(project_id, round))
+        if model_url is None:
+            raise Http404
 
-        # get status param (if available, if not get JOIN_ROUND)
-        status = request.query_params.get("status", JoinedRounds.Status.JOIN_ROUND)
-
-        # join round
-        round_model = self.get_round(project, round)
-        device = request.user.profile.device
-
-        # check if already joined
-        try:
-            joinedRounds = JoinedRounds.objects.get(round=round_model, device=device)
-            joinedRounds.status = status
-            joinedRounds.date_last_state = timezone.now()
-            joinedRounds.save()
-
-        except JoinedRounds.DoesNotExist:
-            joinedRounds = None
+        # apps with samples for the device (at most number_of_apps)
+        apps = urlcache.cached_listdir(
+            urlcache.apps_key(dataset_type, samples_index),
+            os.path.join(consts.SAMPLES_PATH, dataset_type, str(samples_index)))
+        apps = sorted(apps, key=lambda app: app.zfill(8))[:project.number_of_apps]
+
+        samples = {}
+        for app in apps:
+            url = urlcache.cached_url(
+                urlcache.samples_key(dataset_type, samples_index, app),
+                lambda: resolve_samples_path(dataset_type, samples_index, app))
+            if url is not None:
+                samples[app] = url
+
+        return Response({
+            'model': model_url,
+            'model_etag': urlcache.cached(urlcache.etag_key(project_id, round), lambda: resolve_model_etag(project_id, round)),
+            'samples': samples,
+        })
+
+
+def join_round(device, project_id, round, status):
+
+    # get round of the project
+    try:
+        round_model = Round.objects.get(
+            project_id=project_id,
+            round_number=round)
+
+    except (Round.DoesNotExist, ValueError):
+        raise Http404
+
+    # check if already joined
+    try:
+        joinedRounds = JoinedRounds.objects.get(round=round_model, device=device)
+        joinedRounds.status = status
+        joinedRounds.date_last_state = timezone.now()
+        joinedRounds.save()
+
+    except JoinedRounds.DoesNotExist:
+        joinedRounds = None
+
+    # if not joined
+    if not joinedRounds:
+
+        # create object
+        JoinedRounds.objects.create(
+            round=round_model,
+            device=device,
+            status=status)
 
-        # if not joined
-        if not joinedRounds:
+        # the device got the train request (if it was pushed one)
+        acknowledge_train_request(device, round_model)
 
-            # create object
-            JoinedRounds.objects.create(
-                round=round_model,
-                device=device,
-                status=status)
+    serializer = RoundSerializer(round_model)
+    return serializer.data
 
-        serializer = RoundSerializer(round_model)
-        return Response(serializer.data)
 
-
-class ReportAvailibility(APIView):
+class JoinRound(APIView):
     permission_classes = (IsAuthenticated,)
 
-    # def get_project(self, id):
-    #     try:
-    #         return Project.objects.get(pk=id)
+    def get(self, request, project_id, round):
 
-    #     except Project.DoesNotExist:
-    #         raise Http404
+        # get status param (if available, if not get JOIN_ROUND)
+        status = request.query_params.get("status", JoinedRounds.Status.JOIN_ROUND)
 
-    def get_device_train_request(self, request_id):
-        try:
-            return DeviceTrainRequest.objects.get(pk=request_id)
+        # join round
+        device = request.user.profile.device
+        return Response(join_round(device, project_id, round, status))
 
-        except DeviceTrainRequest.DoesNotExist:
-            raise Http404
 
-    def post(self, request):
+# device pings (see ingestion.BulkBuffer)
+status_responses = BulkBuffer(DeviceStatusResponse, settings.STATUS_BUFFER_SIZE, settings.STATUS_BUFFER_INTERVAL)
 
-        # Get device (should have used a serializer)
-        device = request.user.profile.device
 
-        # print(request.data)  # debug
-        request_type = request.data.get('request_type')
-        device_info = request.data.get('device_info')
-        if device_info is None:
-            return Response(status=status.HTTP_400_BAD_REQUEST)
+def report_availability(device, data):
 
-        # Save device details
-        device_details = device_info.get("device_details")
-        if device_details is None:
-            return Response(status=status.HTTP_400_BAD_REQUEST)
+    # store a device ping or train response, returns the HTTP status of the response
+    # print(data)  # debug
+    request_type = data.get('request_type')
+    device_info = data.get('device_info')
+    if device_info is None:
+        return status.HTTP_400_BAD_REQUEST
+
+    # Save device details
+    device_details = device_info.get("device_details")
+    if device_details is None:
+        return status.HTTP_400_BAD_REQUEST
+    details_hash = hashlib.sha1(json.dumps(device_details, sort_keys=True).encode('utf-8')).hexdigest()
+    if details_hash != device.details_hash:
         device.model = device_details.get("model")
         device.os_version = device_details.get("os_version")
         device.manufacturer = device_details.get("manufacturer")
@@ -205,29 +308,56 @@ class ReportAvailibility(APIView):
         device.os = device_details.get("os")
         device.os_version = device_details.get("version")
         device.security_patch = device_details.get("security_patch")
+        device.details_hash = details_hash
         device.save()
 
-        # if train request, get the associated model (else none)
-        if request_type == "device-ping":
-            device_train_request = None
+    # if train request, get the associated model (else none)
+    if request_type == "device-ping":
+        device_train_request = None
 
-        elif request_type == "device-train":
-            request_id = request.data.get('request_id')
-            if request_id is None:
-                return Response(status=status.HTTP_400_BAD_REQUEST)
+    elif request_type == "device-train":
+        request_id = data.get('request_id')
+        if request_id is None:
+            return status.HTTP_400_BAD_REQUEST
 
-            device_train_request = self.get_device_train_request(request_id)
+        try:
+            device_train_request = DeviceTrainRequest.objects.get(pk=request_id)
+        except DeviceTrainRequest.DoesNotExist:
+            raise Http404
 
-        else:
-            return Response(status=status.HTTP_400_BAD_REQUEST)
+    else:
+        return status.HTTP_400_BAD_REQUEST
 
-        # create the object in the db
-        DeviceStatusResponse.objects.create(
-            device=device,
-            device_train_request=device_train_request,
-            data=device_info)
+    # create the object in the db (pings are buffered and inserted in bulk, train responses are
+    # written at once as the scheduler waits for them)
+    response = DeviceStatusResponse(
+        device=device,
+        device_train_request=device_train_request,
+        data=device_info,
+        **device_status_fields(device_info))
+    if device_train_request is None:
+        status_responses.add(response)
+    else:
+        response.save()
 
-        return Response(status=status.HTTP_201_CREATED)
+        # wake up the scheduler (the round completes once all devices respond)
+        SchedulerEvent.objects.create(project_id=device_train_request.round.project_id, reason='train-response')
+        acknowledge_train_request(device, device_train_request.round)
+
+    # keep the latest status of the device (for selecting available devices)
+    record_latest_status(device, device_info)
+
+    return status.HTTP_201_CREATED
+
+
+class ReportAvailibility(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+
+        # Get device (should have used a serializer)
+        device = request.user.profile.device
+        return Response(status=report_availability(device, request.data))
 
 
 class ResultsUploadParser(FileUploadParser):
@@ -281,19 +411,136 @@ class SubmitModel(APIView):
         project = self.get_project(project_id)
         device_id = request.user.profile.device.id
 
+        # stream the upload to disk (model weights are checked against the size of the project's model)
+        expected_size = None
+        if filename == consts.MODEL_WEIGHTS_FILENAME:
+            expected_size = modelregistry.get_spec(project.model).size * WEIGHTS_DTYPE.itemsize
+        request.upload_handlers = [uploads.ModelUploadHandler(request, expected_size)]
+
         if 'file' not in request.data:
             raise ParseError("Empty content")
 
         # session level
         path = os.path.join(consts.PROJECTS_PATH, str(project.id), str(round), str(device_id))
 
+        # get round (if training, model weights are folded into its partial aggregate)
+        round_model = None
+        if round.isdigit():
+            round_model = Round.objects.filter(project=project, round_number=int(round)).first()
+
         # save file
         file = request.data['file']
-        default_storage.save(os.path.join(path, file.name), file)
+        if file.name == consts.MODEL_WEIGHTS_FILENAME and round_model is not None and round_model.status == Round.Status.TRAINING:
+            sc.fold_model(round_model, device_id, file)
+        else:
+            default_storage.save(os.path.join(path, file.name), file)
+
+        # remove the temporary file (unless it was moved into the storage)
+        file.close()
+
+        return Response(status=status.HTTP_201_CREATED)
+
+
+class RequestUpload(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get_project(self, project_id):
+        try:
+            return Project.objects.get(pk=project_id)
+
+        except Project.DoesNotExist:
+            raise Http404
+
+    def post(self, request, project_id, round, filename):
+
+        project = self.get_project(project_id)
+        device_id = request.user.profile.device.id
+
+        if filename in ('.', '..'):
+            raise ParseError("Invalid filename")
+
+        # session level
+        path = os.path.join(consts.PROJECTS_PATH, str(project.id), str(round), str(device_id), filename)
+
+        # model weights are staged until the upload completes (results are stored directly)
+        if filename == consts.MODEL_WEIGHTS_FILENAME:
+            path += uploads.STAGING_SUFFIX
+            content_type = ModelUploadParser.media_type
+        else:
+            content_type = ResultsUploadParser.media_type
+
+        return Response({
+            'url': uploads.upload_url(request, path, content_type),
+            'method': 'PUT',
+            'content_type': content_type,
+            'expires_in': settings.UPLOAD_URL_EXPIRY,
+        })
+
+
+class CompleteUpload(APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def get_project(self, project_id):
+        try:
+            return Project.objects.get(pk=project_id)
+
+        except Project.DoesNotExist:
+            raise Http404
+
+    def post(self, request, project_id, round, filename):
+
+        project = self.get_project(project_id)
+        device_id = request.user.profile.device.id
+
+        # session level
+        file_path = os.path.join(consts.PROJECTS_PATH, str(project.id), str(round), str(device_id), filename)
+
+        # results are already in place
+        if filename != consts.MODEL_WEIGHTS_FILENAME:
+            if not default_storage.exists(file_path):
+                raise Http404
+            return Response(status=status.HTTP_201_CREATED)
+
+        staged_path = file_path + uploads.STAGING_SUFFIX
+        if not default_storage.exists(staged_path):
+            raise Http404
+
+        # get round (if training, model weights are folded into its partial aggregate)
+        round_model = None
+        if round.isdigit():
+            round_model = Round.objects.filter(project=project, round_number=int(round)).first()
+
+        # moved server-side (the model never passes through the server)
+        if round_model is not None and round_model.status == Round.Status.TRAINING:
+            sc.fold_model(round_model, device_id, staged_path=staged_path)
+        else:
+            filecopy(staged_path, file_path)
+            default_storage.delete(staged_path)
 
         return Response(status=status.HTTP_201_CREATED)
 
 
+class LocalUpload(APIView):
+
+    # stand-in for presigned S3 urls (the signed token authorizes the upload)
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+
+    def put(self, request, token):
+
+        try:
+            path = uploads.upload_path(token)
+        except signing.BadSignature:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        if request.stream is None:
+            raise ParseError("Empty content")
+
+        uploads.save_stream(path, request.stream)
+
+        return Response(status=status.HTTP_200_OK)
+
+
 class ComputePerformance(APIView):
 
     def post(self, request):